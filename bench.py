@@ -0,0 +1,157 @@
+# %% import packages
+import json
+import os
+import subprocess
+import sys
+import time
+
+from checkers import ASPIRATION_WINDOW, MoveOrdering, SearchStats, TranspositionTable, all_moves_color, \
+    alpha_beta_search, another_color, fen_position, generate_moves, iterative_deepening
+
+
+# %% Corpus
+def load_positions(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_positions.txt')):
+    # [(name, board, color, perft counts)]
+    positions = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            name, fen, counts = [field.strip() for field in line.split(';')]
+            board, color = fen_position(fen)
+            positions.append((name, board, color, [int(n) for n in counts.split()]))
+    return positions
+
+
+# %% Perft
+def perft(board, color, depth):
+    # Number of move sequences of the given length, walked in place
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in generate_moves(board, color):
+        undo = board.apply_move(move)
+        nodes += perft(board, another_color(color), depth - 1)
+        board.undo_move(move, undo)
+    return nodes
+
+
+def perft_results(board, color, depth):
+    # Same count through all_moves_color and the result boards it copies
+    if depth == 0:
+        return 1
+    moves, results = all_moves_color(board, color)
+    return sum(perft_results(result, another_color(color), depth - 1) for result in results)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+# %% Benchmarks
+def run(positions, search_depth=7, heuristics=(1, 2), board_depth=3, emit=print):
+    # Emits one json object per measurement; 'ok' is False when a perft
+    # count differs from the corpus.
+    failures = 0
+    for name, board, color, counts in positions:
+        for depth, expected in enumerate(counts, 1):
+            nodes, seconds = timed(perft, board, color, depth)
+            failures += nodes != expected
+            emit({'bench': 'perft', 'position': name, 'depth': depth, 'nodes': nodes, 'expected': expected,
+                  'ok': nodes == expected, 'seconds': seconds})
+        for depth, expected in enumerate(counts[:board_depth], 1):
+            nodes, seconds = timed(perft_results, board.to_board(), color, depth)
+            failures += nodes != expected
+            emit({'bench': 'perft_board', 'position': name, 'depth': depth, 'nodes': nodes, 'expected': expected,
+                  'ok': nodes == expected, 'seconds': seconds})
+        for heuristic_type in heuristics:
+            stats = SearchStats()
+            (action, result), seconds = timed(alpha_beta_search, board, color, search_depth, heuristic_type,
+                                              TranspositionTable(), None, None, MoveOrdering(), stats)
+            emit({'bench': 'search', 'position': name, 'heuristic': heuristic_type, 'depth': search_depth,
+                  'nodes': stats.nodes, 'move': action, 'score': stats.score, 'seconds': seconds,
+                  'nps': stats.nps()})
+    return failures
+
+
+def run_pvs(positions, search_depth=7, heuristics=(1, 2), emit=print):
+    # Nodes of iterative deepening to search_depth with plain alpha-beta, PVS
+    # and PVS with aspiration windows. Returns {(heuristic, mode): nodes}.
+    modes = [('alphabeta', {}), ('pvs', {'pvs': True})]
+    totals = {}
+    for name, board, color, counts in positions:
+        for heuristic_type in heuristics:
+            for mode, options in modes + [('pvs+aspiration', {'pvs': True,
+                                                              'aspiration': ASPIRATION_WINDOW[heuristic_type]})]:
+                stats = SearchStats()
+                (action, result), seconds = timed(iterative_deepening, board, color, maxdepth=search_depth,
+                                                  heuristic_type=heuristic_type, stats=stats, **options)
+                totals[(heuristic_type, mode)] = totals.get((heuristic_type, mode), 0) + stats.nodes
+                emit({'bench': 'pvs', 'position': name, 'heuristic': heuristic_type, 'mode': mode,
+                      'depth': search_depth, 'nodes': stats.nodes, 'researches': stats.researches,
+                      'aspiration_fails': stats.aspiration_fails, 'move': action, 'seconds': seconds})
+    return totals
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(old_path, new_path):
+    # Time ratio new / old for every measurement found in both runs
+    def key(record):
+        return record.get('bench'), record.get('position'), record.get('depth'), record.get('heuristic'), \
+            record.get('mode')
+    old = {key(record): record for record in load_results(old_path) if 'seconds' in record}
+    total_old, total_new = 0.0, 0.0
+    for record in load_results(new_path):
+        if 'seconds' not in record or key(record) not in old:
+            continue
+        before = old[key(record)]
+        total_old += before['seconds']
+        total_new += record['seconds']
+        changed = before.get('nodes') != record.get('nodes') or before.get('move') != record.get('move')
+        print('%-12s %-20s depth %-2s h%-4s %9.4fs %9.4fs %6.2fx%s'
+              % (record['bench'], record['position'], record['depth'], record.get('heuristic', '-'),
+                 before['seconds'], record['seconds'], record['seconds'] / max(before['seconds'], 1e-9),
+                 '  nodes or move changed' if changed else ''))
+    if total_old:
+        print('total %.3fs -> %.3fs (%.2fx)' % (total_old, total_new, total_new / total_old))
+
+
+if __name__ == '__main__':
+    # python bench.py [search depth] > bench_output.txt
+    # python bench.py --compare old.txt new.txt
+    # python bench.py --pvs [search depth]
+    args = sys.argv[1:]
+
+    def emit(record):
+        print(json.dumps(record))
+        sys.stdout.flush()
+    if len(args) == 3 and args[0] == '--compare':
+        compare(args[1], args[2])
+    elif args and args[0] == '--pvs':
+        totals = run_pvs(load_positions(), int(args[1]) if len(args) > 1 else 7, emit=emit)
+        for (heuristic_type, mode), nodes in sorted(totals.items()):
+            base = totals[(heuristic_type, 'alphabeta')]
+            emit({'bench': 'pvs_summary', 'heuristic': heuristic_type, 'mode': mode, 'nodes': nodes,
+                  'reduction': 1.0 - nodes / base if base else 0.0})
+    else:
+        start = time.perf_counter()
+        failures = run(load_positions(), int(args[0]) if args else 7, emit=emit)
+        emit({'bench': 'summary', 'revision': revision(), 'failures': failures,
+              'total_seconds': time.perf_counter() - start})
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,159 @@
+# %% import packages
+import copy
+import json
+import random
+import struct
+import sys
+import time
+
+import numpy as np
+
+from checkers import BitBoard, SQUARE_INDEX, ZOBRIST_TURN, TranspositionTable, another_color, generate_moves, \
+    move_result, search_root
+
+
+# %% Book format
+# A header followed by fixed-size records sorted by position key, so a lookup
+# is one binary search. The key is the zobrist hash of the board with the side
+# to move; a move is identified by its from-square, to-square and the mask of
+# the squares it captures (this also tells apart jumps sharing both ends).
+MAGIC = b'CKBK'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+RECORD = np.dtype([('key', '<u8'), ('captured', '<u4'), ('start', 'u1'), ('end', 'u1'), ('weight', '<u2')])
+MAX_WEIGHT = 0xFFFF
+
+
+def position_key(board, color):
+    return board.zobrist ^ ZOBRIST_TURN[color]
+
+
+def move_key(move):
+    captured = 0
+    for square in move.captured:
+        captured |= 1 << SQUARE_INDEX[tuple(square)]
+    return SQUARE_INDEX[tuple(move.start)], SQUARE_INDEX[tuple(move.end)], captured
+
+
+def add_entry(entries, board, color, move, weight=1):
+    # entries maps (position key, start, end, captured) to a weight
+    start, end, captured = move_key(move)
+    key = (position_key(board, color), start, end, captured)
+    entries[key] = entries.get(key, 0) + weight
+
+
+def write_book(path, entries):
+    records = np.zeros(len(entries), dtype=RECORD)
+    for i, ((key, start, end, captured), weight) in enumerate(sorted(entries.items())):
+        records[i] = (key, captured, start, end, min(weight, MAX_WEIGHT))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        f.write(records.tobytes())
+
+
+# %% Building
+def build_from_search(plies=3, depth=9, heuristic_type=1, margin=0.0, verbose=True):
+    # Searches every position reachable in the first plies moves and books
+    # each move scoring within margin of the best one.
+    entries = {}
+    tt = TranspositionTable(64)
+    frontier = [(BitBoard(), 'Black')]
+    for ply in range(plies):
+        start = time.perf_counter()
+        children = []
+        for board, color in frontier:
+            moves = generate_moves(board, color)
+            scores = []
+            for move in moves:
+                tt.new_search()
+                scores.append(search_root(copy.deepcopy(board), color, [move], maxdepth=depth,
+                                          heuristic_type=heuristic_type, tt=tt)[1])
+            if moves:
+                best = max(scores)
+                for move, score in zip(moves, scores):
+                    if score >= best - margin:
+                        add_entry(entries, board, color, move)
+            children += [(move_result(board, move), another_color(color)) for move in moves]
+        frontier = children
+        if verbose:
+            print('ply %d: %d entries, %.1fs' % (ply + 1, len(entries), time.perf_counter() - start))
+    return entries
+
+
+def build_from_games(records, plies=10, entries=None):
+    # Books the moves of finished games, e.g. tournament records: a move of
+    # the winner counts twice, a move from a drawn game once, and the loser's
+    # moves are left out.
+    entries = {} if entries is None else entries
+    for record in records:
+        board = BitBoard()
+        color = 'Black'
+        for path in record['moves'][:plies]:
+            path = [tuple(pos) for pos in path]
+            move = None
+            for candidate in generate_moves(board, color):
+                if list(candidate.path) == path:
+                    move = candidate
+                    break
+            if move is None:
+                break
+            if record['winner'] is None:
+                add_entry(entries, board, color, move, 1)
+            elif record['winner'] == color:
+                add_entry(entries, board, color, move, 2)
+            board = move_result(board, move)
+            color = another_color(color)
+    return entries
+
+
+# %% Lookup
+class Book(object):
+    def __init__(self, path, rng=None):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d opening book." % (path, VERSION))
+        self.records = np.memmap(path, dtype=RECORD, mode='r', offset=HEADER.size, shape=(count,)) \
+            if count else np.zeros(0, dtype=RECORD)
+        self.rng = random.Random() if rng is None else rng
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def probe(self, board, color):
+        # Legal book moves of the position with their weights
+        key = np.uint64(position_key(board, color))
+        low = np.searchsorted(self.records['key'], key, 'left')
+        high = np.searchsorted(self.records['key'], key, 'right')
+        if low == high:
+            return []
+        weights = {}
+        for record in self.records[low:high]:
+            weights[(int(record['start']), int(record['end']), int(record['captured']))] = int(record['weight'])
+        return [(move, weights[move_key(move)]) for move in generate_moves(board, color)
+                if weights.get(move_key(move), 0) > 0]
+
+    def choose(self, board, color, rng=None):
+        # Weighted random book move, or None when the position is not booked
+        candidates = self.probe(board, color)
+        if not candidates:
+            return None
+        rng = self.rng if rng is None else rng
+        return rng.choices([move for move, weight in candidates], [weight for move, weight in candidates])[0]
+
+
+if __name__ == '__main__':
+    # python book.py [plies] [depth] [path] [tournament.jsonl ...]
+    args = sys.argv[1:]
+    entries = build_from_search(int(args[0]) if args else 3, int(args[1]) if len(args) > 1 else 9)
+    for name in args[3:]:
+        with open(name) as f:
+            build_from_games([json.loads(line) for line in f if line.strip()], entries=entries)
+    write_book(args[2] if len(args) > 2 else 'opening.ckbk', entries)
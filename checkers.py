@@ -1,11 +1,40 @@
 # %% import packages
 import numpy as np
 import copy
+import itertools
+import json
+import os
+import random
+import struct
+import time
+from collections import namedtuple
+
+
+# %% Zobrist keys
+# One 64-bit key per square and piece kind (black man, black king, white man,
+# white king), plus keys for the side to move and the searching agent.
+_zobrist_random = random.Random(2022)
+ZOBRIST_PIECE = [[[_zobrist_random.getrandbits(64) for k in range(4)] for c in range(8)] for r in range(8)]
+ZOBRIST_TURN = {'Black': 0, 'White': _zobrist_random.getrandbits(64)}
+ZOBRIST_AGENT = {'Black': _zobrist_random.getrandbits(64), 'White': _zobrist_random.getrandbits(64)}
+ZOBRIST_HEURISTIC = [_zobrist_random.getrandbits(64) for k in range(8)]
+
+
+def zobrist_key(row, col, piece):
+    return ZOBRIST_PIECE[row][col][(2 if piece.color == 'White' else 0) + (1 if piece.king else 0)]
+
+
+# %% Evaluation feature tables
+# "Safe distance" of a square as used by evaluate3
+SAFE_DISTANCE = [[int(((max(r, 7 - r) ** 2.0 + max(c, 7 - c) ** 2.0) ** 0.5) / 2.0) for c in range(8)]
+                 for r in range(8)]
+# When True, every evaluation checks the running features against a full scan
+CHECK_INCREMENTAL = False
 
 
 # %% Important classes
 class Piece(object):
-    king = False
+    __slots__ = ('color', 'king')
 
     def __init__(self, color='Black', is_king=False):
         if color in ['Black', 'White']:
@@ -38,6 +67,20 @@ class Piece(object):
         return self.__str__()
 
 
+class Move(namedtuple('Move', ['path', 'captured', 'promote'])):
+    # path starts at the from-square, captured lists the jumped squares in
+    # order and promote tells whether the moving man is crowned on the way.
+    __slots__ = ()
+
+    @property
+    def start(self):
+        return self.path[0]
+
+    @property
+    def end(self):
+        return self.path[-1]
+
+
 class Board(object):
     def __init__(self):
         self.len = 8
@@ -62,6 +105,27 @@ class Board(object):
                 self.status[r][c] = Piece('White')
                 self.white_position.append((r, c))
 
+        # Running zobrist key and evaluation features, kept up to date by place/remove:
+        # piece counts by kind (black man, black king, white man, white king),
+        # and for black and white men the king-row and safe distance sums.
+        self.zobrist = 0
+        self.counts = [0, 0, 0, 0]
+        self.king_distance = [0, 0]
+        self.safe_distance = [0, 0]
+        for (r, c) in self.black_position + self.white_position:
+            self._account(r, c, self.status[r][c], 1)
+
+    def _account(self, row, col, piece, sign):
+        kind = (2 if piece.color == 'White' else 0) + (1 if piece.king else 0)
+        self.zobrist ^= ZOBRIST_PIECE[row][col][kind]
+        self.counts[kind] += sign
+        if not piece.king:
+            if kind == 0:
+                self.king_distance[0] += sign * (row + 1)
+            else:
+                self.king_distance[1] += sign * (self.len - (row + 1))
+            self.safe_distance[kind >> 1] += sign * SAFE_DISTANCE[row][col]
+
     def is_free(self, row, col):
         return self.status[row][col] is None
 
@@ -76,6 +140,7 @@ class Board(object):
             self.black_position.remove((row, col))
         else:
             self.white_position.remove((row, col))
+        self._account(row, col, self.status[row][col], -1)
         self.status[row][col] = None
 
     def place(self, row, col, piece):
@@ -87,14 +152,98 @@ class Board(object):
             self.white_position.append((row, col))
             if row == 0:
                 piece.turn_king()
+        self._account(row, col, piece, 1)
         self.status[row][col] = piece
 
+    def turn_king(self, row, col):
+        piece = self.status[row][col]
+        if not piece.king:
+            self._account(row, col, piece, -1)
+            piece.turn_king()
+            self._account(row, col, piece, 1)
+
     def get_color_pos(self, color = 'Black'):
         if color == 'Black':
             return self.black_position
         elif color == 'White':
             return self.white_position
 
+    def piece_counts(self):
+        return tuple(self.counts)
+
+    def king_distances(self):
+        return tuple(self.king_distance)
+
+    def safe_distances(self):
+        return tuple(self.safe_distance)
+
+    def jump_counts(self):
+        bc, wc = 0, 0
+        for (r, c) in self.black_position:
+            bc += len(check_jump(self, r, c))
+        for (r, c) in self.white_position:
+            wc += len(check_jump(self, r, c))
+        return bc, wc
+
+    def has_moves(self, color):
+        # Stops at the first piece that can move, without building any move
+        for (r, c) in self.get_color_pos(color):
+            if check_simple_move(self, r, c) or check_jump(self, r, c):
+                return True
+        return False
+
+    def has_jumps(self, color):
+        for (r, c) in self.get_color_pos(color):
+            if check_jump(self, r, c):
+                return True
+        return False
+
+    def apply_move(self, move):
+        # The moving piece keeps its place in its position list and captured
+        # pieces are popped from theirs, so the undo record only holds the
+        # list indices needed to put everything back in the same order
+        (row, col) = move.start
+        (r, c) = move.end
+        piece = self.status[row][col]
+        own, other = (self.black_position, self.white_position) if piece.color == 'Black' \
+            else (self.white_position, self.black_position)
+        index = own.index((row, col))
+        captured = []
+        for (x, y) in move.captured:
+            captured_piece = self.status[x][y]
+            i = other.index((x, y))
+            del other[i]
+            self._account(x, y, captured_piece, -1)
+            self.status[x][y] = None
+            captured.append((x, y, captured_piece, i))
+        was_king = piece.king
+        self._account(row, col, piece, -1)
+        self.status[row][col] = None
+        if move.promote:
+            piece.turn_king()
+        own[index] = (r, c)
+        self.status[r][c] = piece
+        self._account(r, c, piece, 1)
+        return was_king, index, captured
+
+    def undo_move(self, move, undo):
+        was_king, index, captured = undo
+        (row, col) = move.start
+        (r, c) = move.end
+        piece = self.status[r][c]
+        own, other = (self.black_position, self.white_position) if piece.color == 'Black' \
+            else (self.white_position, self.black_position)
+        self._account(r, c, piece, -1)
+        self.status[r][c] = None
+        piece.king = was_king
+        own[index] = (row, col)
+        self.status[row][col] = piece
+        self._account(row, col, piece, 1)
+        for (x, y, captured_piece, i) in reversed(captured):
+            other.insert(i, (x, y))
+            self.status[x][y] = captured_piece
+            self._account(x, y, captured_piece, 1)
+
     def is_empty(self):
         for r in range(self.len):
             for c in range(self.len):
@@ -120,7 +269,7 @@ class Board(object):
             str_ += chr(97 + r) + ' |'
             for c in range(0, self.len):
                 str_ += ' ' + \
-                        (str(self.status[r][c]) if self.status[r][c] is not None else ' ') + ' |'
+                        (str(self.get(r, c)) if not self.is_free(r, c) else ' ') + ' |'
             str_ += vline
         return str_
 
@@ -128,138 +277,538 @@ class Board(object):
         return self.__str__()
 
 
+# %% Bitboard representation
+# The 32 dark squares are numbered row by row, four per row, so each colour
+# fits in a single 32-bit integer: index = row * 4 + col // 2.
+BIT_FULL = 0xFFFFFFFF
+SQUARE_INDEX = {}
+INDEX_SQUARE = []
+for _r in range(8):
+    for _c in range(8):
+        if (_r + _c) % 2 == 1:
+            SQUARE_INDEX[(_r, _c)] = len(INDEX_SQUARE)
+            INDEX_SQUARE.append((_r, _c))
+
+BIT_ZOBRIST = [ZOBRIST_PIECE[r][c] for (r, c) in INDEX_SQUARE]
+
+BIT_ROWS = [0xF << (4 * r) for r in range(8)]
+BIT_SAFE = {}
+for _i, (_r, _c) in enumerate(INDEX_SQUARE):
+    BIT_SAFE[SAFE_DISTANCE[_r][_c]] = BIT_SAFE.get(SAFE_DISTANCE[_r][_c], 0) | (1 << _i)
+
+BIT_BLACK_START = (1 << 12) - 1
+BIT_WHITE_START = BIT_FULL ^ ((1 << 20) - 1)
+BIT_KING_ROW = {'Black': 0xF << 28, 'White': 0xF}
+
+# For every diagonal direction the shift depends on the parity of the source
+# row, so each direction keeps (mask, shift) for even rows and for odd rows.
+# The masks only keep the sources whose neighbour is on the board.
+BIT_DIRECTIONS = {}
+for _d in [(+1, -1), (+1, +1), (-1, -1), (-1, +1)]:
+    _parts = []
+    for _parity in (0, 1):
+        _mask, _shift = 0, 0
+        for _i, (_r, _c) in enumerate(INDEX_SQUARE):
+            if _r % 2 == _parity and (_r + _d[0], _c + _d[1]) in SQUARE_INDEX:
+                _mask |= 1 << _i
+                _shift = SQUARE_INDEX[(_r + _d[0], _c + _d[1])] - _i
+        _parts.append((_mask, _shift))
+    BIT_DIRECTIONS[_d] = tuple(_parts)
+
+# Same direction order as check_simple_move / check_jump
+UP_DIRECTIONS = {'Black': [(+1, -1), (+1, +1)], 'White': [(-1, -1), (-1, +1)]}
+DOWN_DIRECTIONS = {'Black': [(-1, -1), (-1, +1)], 'White': [(+1, -1), (+1, +1)]}
+KING_ROW = {'Black': 7, 'White': 0}
+
+# Diagonal neighbours and jumps (offset, middle square, landing square) of
+# every square for each kind of piece, in the direction order above
+PIECE_STEPS = {}
+PIECE_JUMPS = {}
+for _color in ('Black', 'White'):
+    for _king in (False, True):
+        _ds = UP_DIRECTIONS[_color] + DOWN_DIRECTIONS[_color] if _king else UP_DIRECTIONS[_color]
+        PIECE_STEPS[(_color, _king)] = [[[((_x, _y), (_r + _x, _c + _y)) for (_x, _y) in _ds
+                                          if 0 <= _r + _x < 8 and 0 <= _c + _y < 8]
+                                         for _c in range(8)] for _r in range(8)]
+        PIECE_JUMPS[(_color, _king)] = [[[((2 * _x, 2 * _y), (_r + _x, _c + _y), (_r + 2 * _x, _c + 2 * _y))
+                                          for (_x, _y) in _ds if 0 <= _r + 2 * _x < 8 and 0 <= _c + 2 * _y < 8]
+                                         for _c in range(8)] for _r in range(8)]
+
+
+def bit_step(mask, direction):
+    (even_mask, even_shift), (odd_mask, odd_shift) = BIT_DIRECTIONS[direction]
+    even = mask & even_mask
+    odd = mask & odd_mask
+    even = (even << even_shift) if even_shift >= 0 else (even >> -even_shift)
+    odd = (odd << odd_shift) if odd_shift >= 0 else (odd >> -odd_shift)
+    return (even | odd) & BIT_FULL
+
+
+def bit_indices(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def bit_count(mask):
+    return bin(mask).count('1')
+
+
+def bit_zobrist(black, white, kings):
+    key = 0
+    for i in bit_indices(black):
+        key ^= BIT_ZOBRIST[i][1 if (kings >> i) & 1 else 0]
+    for i in bit_indices(white):
+        key ^= BIT_ZOBRIST[i][3 if (kings >> i) & 1 else 2]
+    return key
+
+
+class BitBoard(Board):
+    def __init__(self, black=BIT_BLACK_START, white=BIT_WHITE_START, kings=0, zobrist=None):
+        self.len = 8
+        self.black = black
+        self.white = white
+        self.kings = kings
+        self.zobrist = bit_zobrist(black, white, kings) if zobrist is None else zobrist
+
+    @classmethod
+    def from_board(cls, board):
+        black, white, kings = 0, 0, 0
+        for (r, c), i in SQUARE_INDEX.items():
+            piece = board.get(r, c)
+            if piece:
+                if piece.color == 'Black':
+                    black |= 1 << i
+                else:
+                    white |= 1 << i
+                if piece.king:
+                    kings |= 1 << i
+        return cls(black, white, kings)
+
+    def to_board(self):
+        board = Board()
+        for (r, c) in board.black_position + board.white_position:
+            board.remove(r, c)
+        for i in bit_indices(self.black | self.white):
+            (r, c) = INDEX_SQUARE[i]
+            board.place(r, c, self.get(r, c))
+        return board
+
+    def is_free(self, row, col):
+        i = SQUARE_INDEX.get((row, col))
+        return i is None or not ((self.black | self.white) >> i) & 1
+
+    def get(self, row, col):
+        i = SQUARE_INDEX.get((row, col))
+        if i is None:
+            return None
+        if (self.black >> i) & 1:
+            return Piece('Black', bool((self.kings >> i) & 1))
+        if (self.white >> i) & 1:
+            return Piece('White', bool((self.kings >> i) & 1))
+        return None
+
+    def remove(self, row, col):
+        i = SQUARE_INDEX[(row, col)]
+        bit = 1 << i
+        if (self.black | self.white) & bit:
+            self.zobrist ^= BIT_ZOBRIST[i][(2 if self.white & bit else 0) + (1 if self.kings & bit else 0)]
+        self.black &= ~bit
+        self.white &= ~bit
+        self.kings &= ~bit
+
+    def place(self, row, col, piece):
+        bit = 1 << SQUARE_INDEX[(row, col)]
+        if piece.color == 'Black':
+            self.black |= bit
+            if row == self.len-1:
+                piece.turn_king()
+        else:
+            self.white |= bit
+            if row == 0:
+                piece.turn_king()
+        if piece.king:
+            self.kings |= bit
+        else:
+            self.kings &= ~bit
+        self.zobrist ^= zobrist_key(row, col, piece)
+
+    def get_color_pos(self, color='Black'):
+        if color == 'Black':
+            return [INDEX_SQUARE[i] for i in bit_indices(self.black)]
+        elif color == 'White':
+            return [INDEX_SQUARE[i] for i in bit_indices(self.white)]
+
+    @property
+    def black_position(self):
+        return self.get_color_pos('Black')
+
+    @property
+    def white_position(self):
+        return self.get_color_pos('White')
+
+    def apply_move(self, move):
+        undo = (self.black, self.white, self.kings, self.zobrist)
+        i = SQUARE_INDEX[move.start]
+        j = SQUARE_INDEX[move.end]
+        start = 1 << i
+        end = 1 << j
+        was_king = self.kings & start
+        (own, other) = (0, 2) if self.black & start else (2, 0)
+        zobrist = self.zobrist ^ BIT_ZOBRIST[i][own + (1 if was_king else 0)] \
+            ^ BIT_ZOBRIST[j][own + (1 if was_king or move.promote else 0)]
+        captured = 0
+        for square in move.captured:
+            k = SQUARE_INDEX[square]
+            captured |= 1 << k
+            zobrist ^= BIT_ZOBRIST[k][other + (1 if (self.kings >> k) & 1 else 0)]
+        if own == 0:
+            self.black = (self.black & ~start) | end
+            self.white &= ~captured
+        else:
+            self.white = (self.white & ~start) | end
+            self.black &= ~captured
+        self.kings &= ~(start | captured)
+        if was_king or move.promote:
+            self.kings |= end
+        self.zobrist = zobrist
+        return undo
+
+    def undo_move(self, move, undo):
+        self.black, self.white, self.kings, self.zobrist = undo
+
+    def turn_king(self, row, col):
+        i = SQUARE_INDEX[(row, col)]
+        bit = 1 << i
+        if not self.kings & bit:
+            own = 2 if self.white & bit else 0
+            self.zobrist ^= BIT_ZOBRIST[i][own] ^ BIT_ZOBRIST[i][own + 1]
+            self.kings |= bit
+
+    # The evaluation features come straight from popcounts of the masks
+    def piece_counts(self):
+        return (bit_count(self.black & ~self.kings), bit_count(self.black & self.kings),
+                bit_count(self.white & ~self.kings), bit_count(self.white & self.kings))
+
+    def king_distances(self):
+        black_men = self.black & ~self.kings
+        white_men = self.white & ~self.kings
+        bkd, wkd = 0, 0
+        for r in range(8):
+            bkd += (r + 1) * bit_count(black_men & BIT_ROWS[r])
+            wkd += (self.len - (r + 1)) * bit_count(white_men & BIT_ROWS[r])
+        return bkd, wkd
+
+    def safe_distances(self):
+        black_men = self.black & ~self.kings
+        white_men = self.white & ~self.kings
+        bsd, wsd = 0, 0
+        for d, mask in BIT_SAFE.items():
+            bsd += d * bit_count(black_men & mask)
+            wsd += d * bit_count(white_men & mask)
+        return bsd, wsd
+
+    def jump_counts(self):
+        empty = ~(self.black | self.white) & BIT_FULL
+        counts = []
+        for color, own, opponent in (('Black', self.black, self.white), ('White', self.white, self.black)):
+            count = 0
+            for direction in UP_DIRECTIONS[color] + DOWN_DIRECTIONS[color]:
+                sources = own if direction in UP_DIRECTIONS[color] else own & self.kings
+                count += bit_count(bit_step(bit_step(sources, direction) & opponent, direction) & empty)
+            counts.append(count)
+        return tuple(counts)
+
+    def has_moves(self, color):
+        own, opponent = (self.black, self.white) if color == 'Black' else (self.white, self.black)
+        empty = ~(self.black | self.white) & BIT_FULL
+        for direction in UP_DIRECTIONS[color] + DOWN_DIRECTIONS[color]:
+            step = bit_step(own if direction in UP_DIRECTIONS[color] else own & self.kings, direction)
+            if step & empty or bit_step(step & opponent, direction) & empty:
+                return True
+        return False
+
+    def has_jumps(self, color):
+        own, opponent = (self.black, self.white) if color == 'Black' else (self.white, self.black)
+        empty = ~(self.black | self.white) & BIT_FULL
+        for direction in UP_DIRECTIONS[color] + DOWN_DIRECTIONS[color]:
+            step = bit_step(own if direction in UP_DIRECTIONS[color] else own & self.kings, direction)
+            if bit_step(step & opponent, direction) & empty:
+                return True
+        return False
+
+    def __copy__(self):
+        return BitBoard(self.black, self.white, self.kings, self.zobrist)
+
+    def __deepcopy__(self, memo):
+        return BitBoard(self.black, self.white, self.kings, self.zobrist)
+
+
+class Position(namedtuple('Position', ['black', 'white', 'kings', 'color'])):
+    # Immutable, hashable position: the three 32-square masks and the side to
+    # move. pack() gives 13 bytes for storing positions in bulk.
+    __slots__ = ()
+    PACKED = struct.Struct('<IIIB')
+
+    @classmethod
+    def from_board(cls, board, color='Black'):
+        return cls(*position_masks(board), color)
+
+    @classmethod
+    def unpack(cls, data):
+        black, white, kings, side = cls.PACKED.unpack(data)
+        return cls(black, white, kings, 'White' if side else 'Black')
+
+    def pack(self):
+        return self.PACKED.pack(self.black, self.white, self.kings, self.color == 'White')
+
+    def to_board(self):
+        # A BitBoard; call its to_board() for the list based Board
+        return BitBoard(self.black, self.white, self.kings)
+
+    def key(self):
+        return bit_zobrist(self.black, self.white, self.kings) ^ ZOBRIST_TURN[self.color]
+
+
+def bit_jump_generator(index, king, promote, color, opponent, empty, path, captured, moves):
+    path.append(INDEX_SQUARE[index])
+    bit = 1 << index
+    jumped = False
+    for direction in (UP_DIRECTIONS[color] + DOWN_DIRECTIONS[color] if king else UP_DIRECTIONS[color]):
+        mid = bit_step(bit, direction) & opponent
+        if not mid:
+            continue
+        land = bit_step(mid, direction) & empty
+        if not land:
+            continue
+        jumped = True
+        crowned = not king and bool(land & BIT_KING_ROW[color])
+        bit_jump_generator(land.bit_length() - 1, king or crowned, promote or crowned, color,
+                           opponent & ~mid, empty, copy.copy(path),
+                           captured + [INDEX_SQUARE[mid.bit_length() - 1]], moves)
+    if not jumped and len(path) > 1:
+        moves.append(Move(tuple(path), tuple(captured), promote))
+
+
+def bitboard_moves(board, color):
+    # Yields the moves of one jumper before looking at the next one, and
+    # simple moves only once it is known that no capture exists
+    if color == 'Black':
+        own, opponent = board.black, board.white
+    else:
+        own, opponent = board.white, board.black
+    empty = ~(board.black | board.white) & BIT_FULL
+
+    # Squares that can start a capture, found with whole-board shifts
+    jumpers = 0
+    for direction in UP_DIRECTIONS[color] + DOWN_DIRECTIONS[color]:
+        back = (-direction[0], -direction[1])
+        sources = own if direction in UP_DIRECTIONS[color] else own & board.kings
+        land = bit_step(bit_step(sources, direction) & opponent, direction) & empty
+        jumpers |= bit_step(bit_step(land, back), back)
+
+    for i in bit_indices(jumpers):
+        bit = 1 << i
+        jumps = []
+        bit_jump_generator(i, bool(board.kings & bit), False, color, opponent, empty | bit, [], [], jumps)
+        yield from jumps
+
+    if not jumpers:
+        for i in bit_indices(own):
+            bit = 1 << i
+            king = bool(board.kings & bit)
+            for direction in (UP_DIRECTIONS[color] + DOWN_DIRECTIONS[color] if king else UP_DIRECTIONS[color]):
+                end = bit_step(bit, direction) & empty
+                if end:
+                    yield Move((INDEX_SQUARE[i], INDEX_SQUARE[end.bit_length() - 1]), (),
+                               not king and bool(end & BIT_KING_ROW[color]))
+
+
+def bitboard_generate(board, color):
+    return list(bitboard_moves(board, color))
+
+
 # %% Move and jump check
 def check_simple_move(board, row, col):
-    length = board.get_len()
     piece = board.get(row, col)
-    simple_move = []
-    if piece:
-        color = piece.get_color()
-        king = piece.is_king()
-        if color == 'Black':
-            down = [(-1, -1), (-1, +1)]
-            up = [(+1, -1), (+1, +1)]
-        else:
-            up = [(-1, -1), (-1, +1)]
-            down = [(+1, -1), (+1, +1)]
-        for (x, y) in up:
-            if (0 <= row + x < length) and (0 <= col + y < length) and board.is_free(row + x, col + y):
-                simple_move.append((x, y))
-        if king:
-            for (x, y) in down:
-                if (0 <= row + x < length) and (0 <= col + y < length) and board.is_free(row + x, col + y):
-                    simple_move.append((x, y))
-    return simple_move
+    if not piece:
+        return []
+    is_free = board.is_free
+    return [step for step, (r, c) in PIECE_STEPS[(piece.color, piece.king)][row][col] if is_free(r, c)]
 
 
 def check_jump(board, row, col):
-    length = board.get_len()
     piece = board.get(row, col)
+    if not piece:
+        return []
+    get, is_free = board.get, board.is_free
     jumps = []
-    if piece:
-        color = piece.get_color()
-        king = piece.is_king()
-        if color == 'Black':
-            down = [(-1, -1), (-1, +1)]
-            up = [(+1, -1), (+1, +1)]
-        else:
-            up = [(-1, -1), (-1, +1)]
-            down = [(+1, -1), (+1, +1)]
-        for (x, y) in up:
-            if (0 <= row + 2 * x < length) \
-                    and (0 <= col + 2 * y < length) \
-                    and not board.is_free(row + x, col + y) \
-                    and board.get(row + x, col + y).get_color() != piece.get_color() \
-                    and board.is_free(row + 2 * x, col + 2 * y):
-                jumps.append((2 * x, 2 * y))
-        for (x, y) in down:
-            if king \
-                    and (0 <= row + 2 * x < length) \
-                    and (0 <= col + 2 * y < length) \
-                    and not board.is_free(row + x, col + y) \
-                    and board.get(row + x, col + y).get_color() != piece.get_color() \
-                    and board.is_free(row + 2 * x, col + 2 * y):
-                jumps.append((2 * x, 2 * y))
+    for jump, (mr, mc), (r, c) in PIECE_JUMPS[(piece.color, piece.king)][row][col]:
+        middle = get(mr, mc)
+        if middle is not None and middle.color != piece.color and is_free(r, c):
+            jumps.append(jump)
     return jumps
 
 
+def jump_paths(board, color, king, promote, origin, path, captured, moves):
+    get, is_free = board.get, board.is_free
+    (row, col) = path[-1]
+    jumped = False
+    for jump, middle, (r, c) in PIECE_JUMPS[(color, king)][row][col]:
+        if middle not in captured and (is_free(r, c) or (r, c) == origin):
+            piece = get(*middle)
+            if piece is not None and piece.color != color:
+                jumped = True
+                crowned = not king and r == KING_ROW[color]
+                jump_paths(board, color, king or crowned, promote or crowned, origin,
+                           path + [(r, c)], captured + [middle], moves)
+    if not jumped and len(path) > 1:
+        moves.append(Move(tuple(path), tuple(captured), promote))
+
+
+def piece_jumps(board, row, col):
+    moves = []
+    piece = board.get(row, col)
+    if piece:
+        jump_paths(board, piece.color, piece.king, False, (row, col), [(row, col)], [], moves)
+    return moves
+
+
+def piece_simple_moves(board, row, col):
+    piece = board.get(row, col)
+    if not piece:
+        return []
+    is_free = board.is_free
+    promote_row = -1 if piece.king else KING_ROW[piece.color]
+    return [Move(((row, col), (r, c)), (), r == promote_row)
+            for step, (r, c) in PIECE_STEPS[(piece.color, piece.king)][row][col] if is_free(r, c)]
+
+
+def iter_moves(board, color, children=False):
+    # Legal moves in generation order, produced only as they are consumed:
+    # the captures of one piece at a time, then the simple moves if there was
+    # no capture. With children, yields (move, board after the move) pairs.
+    moves = bitboard_moves(board, color) if isinstance(board, BitBoard) else board_moves(board, color)
+    if not children:
+        return moves
+    return ((move, move_result(board, move)) for move in moves)
+
+
+def board_moves(board, color):
+    positions = list(board.get_color_pos(color))
+    jumped = False
+    for (row, col) in positions:
+        for move in piece_jumps(board, row, col):
+            jumped = True
+            yield move
+    if not jumped:
+        for (row, col) in positions:
+            yield from piece_simple_moves(board, row, col)
+
+
+def generate_moves(board, color):
+    if isinstance(board, BitBoard):
+        return bitboard_generate(board, color)
+    return list(board_moves(board, color))
+
+
+def is_legal(board, color, move):
+    # Quick check that a move remembered from elsewhere, such as a hash move,
+    # can be played here. Does not check that a capture sequence is complete.
+    piece = board.get(*move.start)
+    if not piece or piece.get_color() != color:
+        return False
+    if move.captured:
+        for square in move.captured:
+            other = board.get(*square)
+            if not other or other.get_color() == color:
+                return False
+        for square in move.path[1:]:
+            if square != move.start and not board.is_free(*square):
+                return False
+    elif not board.is_free(*move.end) or board.has_jumps(color) \
+            or (not piece.is_king() and move.end[0] - move.start[0] != UP_DIRECTIONS[color][0][0]):
+        return False
+    return move.promote == (not piece.is_king() and any(row == KING_ROW[color] for (row, col) in move.path[1:]))
+
+
+def move_result(board, move):
+    result = copy.deepcopy(board)
+    result.apply_move(move)
+    return result
+
+
 def jump_generator(board, row, col, move, moves, results):
-    move.append((row, col))
-    jumps = check_jump(board, row, col)
+    jumps = piece_jumps(board, row, col)
     if not jumps:
-        moves.append(move)
+        moves.append(move + [(row, col)])
         results.append(copy.deepcopy(board))
-    else:
-        for jump in jumps:
-            (r, c) = (row + jump[0], col + jump[1])
-            piece = copy.copy(board.get(row, col))
-            board.remove(row, col)
-            board.place(r, c, copy.deepcopy(piece))
-            # if (piece.color == "Black" and r == board.len - 1) \
-            #     or (piece.color == "White" and r == 0):
-            #     piece.turn_king()
-            rc = int((row + r)/2)
-            cc = int((col + c)/2)
-            captured = copy.copy(board.get(rc, cc))
-            board.remove(rc, cc)
-            jump_generator(board, r, c, copy.copy(move), moves, results)
-            board.place(rc, cc, copy.deepcopy(captured))
-            board.remove(r, c)
-            board.place(row, col, copy.deepcopy(piece))
+    for jump in jumps:
+        moves.append(move + list(jump.path))
+        results.append(move_result(board, jump))
 
 
 def all_moves(board, row, col):
-    moves = []
-    results = []
-    jump_generator(board, row, col, [], moves, results)
-    if moves == [[(row, col)]]:
-        moves = []
-        results = []
+    moves = piece_jumps(board, row, col)
+    results = [move_result(board, move) for move in moves]
     if not moves:
-        simple_moves = check_simple_move(board, row, col)
-        for simple_move in simple_moves:
-            moves.append([(row, col), (row + simple_move[0], col + simple_move[1])])
-    return moves, results
+        moves = piece_simple_moves(board, row, col)
+    return [list(move.path) for move in moves], results
 
 
 def all_moves_color(board, color):
-    jumped = False
-    moves_all = []
-    results_all = []
-    for (row, col) in board.get_color_pos(color):
-        moves = []
-        results = []
-        jump_generator(board, row, col, [], moves, results)
-        if moves != [[(row, col)]]:
-            jumped = True
-            moves_all += moves
-            results_all += results
-
-    if not jumped:
-        pos_list = copy.deepcopy(board.get_color_pos(color))
-        for (row, col) in pos_list:
-            simple_moves = check_simple_move(board, row, col)
-            for simple_move in simple_moves:
-                r = row + simple_move[0]
-                c = col + simple_move[1]
-                moves_all.append([(row, col), (r, c)])
-                piece = copy.copy(board.get(row, col))
-                board.remove(row, col)
-                board.place(r, c, copy.deepcopy(piece))
-                results_all.append(copy.deepcopy(board))
-                board.remove(r, c)
-                board.place(row, col, copy.deepcopy(piece))
-    return moves_all, results_all
+    moves = generate_moves(board, color)
+    return [list(move.path) for move in moves], [move_result(board, move) for move in moves]
 
 
 # %% Game essential functions
 def is_over(board, color='Black'):
-    length = board.get_len()
-    for (r, c) in board.get_color_pos(color):
-        moves = all_moves(board, r, c)
-        if moves:
-            return False
-    return True
+    # The game is over when the side to move has no legal move, which
+    # includes having no piece left
+    return not board.has_moves(color)
+
+
+# A game is drawn when a position comes up for the third time, or after 40
+# moves by each side without a capture or a man moving. 0 turns a rule off.
+DrawRules = namedtuple('DrawRules', ['repetitions', 'quiet_plies'])
+DRAW_RULES = DrawRules(3, 80)
+
+
+def game_key(board, color):
+    return board.zobrist ^ ZOBRIST_TURN[color]
+
+
+def is_progress(board, path):
+    # Whether a move, on the board before it, is a capture or moves a man.
+    # Positions before such a move cannot come up again.
+    return abs(path[1][0] - path[0][0]) == 2 or not board.get(*path[0]).king
+
+
+class GameHistory(object):
+    # Keys of the positions of a game so far, the latest last
+    def __init__(self, board, color, rules=DRAW_RULES):
+        self.rules = rules
+        self.keys = [game_key(board, color)]
+        # plies since the last capture or man move
+        self.quiet = 0
+
+    def push(self, board, color, progress):
+        # board after a move, color to move next
+        self.quiet = 0 if progress else self.quiet + 1
+        self.keys.append(game_key(board, color))
+
+    def reversible(self):
+        # The positions that can still come up again, for the search
+        return self.keys[len(self.keys) - 1 - self.quiet:]
+
+    def draw(self):
+        # The rule the game is drawn by, or None
+        if self.rules.quiet_plies and self.quiet >= self.rules.quiet_plies:
+            return 'no progress'
+        if self.rules.repetitions and self.reversible().count(self.keys[-1]) >= self.rules.repetitions:
+            return 'repetition'
+        return None
 
 
 def position_trans(old_pos):
@@ -276,20 +825,102 @@ def another_color(color):
         return 'Black'
 
 
+def position_fen(board, color):
+    # FEN-like text of a position, e.g. "B:W21,22,K30:B1,2,K9": the side to
+    # move, then the white and black pieces by square number (1-32, along the
+    # rows from Black's side), kings prefixed with K.
+    black, white, kings = position_masks(board)
+
+    def squares(mask):
+        return ','.join(('K' if (kings >> i) & 1 else '') + str(i + 1) for i in bit_indices(mask))
+    return '%s:W%s:B%s' % (color[0], squares(white), squares(black))
+
+
+def fen_position(fen):
+    # Inverse of position_fen, returns (BitBoard, color to move). Raises
+    # ValueError on text it cannot read.
+    fields = fen.strip().split(':')
+    if fields[0].upper() not in ('B', 'W'):
+        raise ValueError("Unknown side to move %r in %r." % (fields[0], fen))
+    color = 'Black' if fields[0].upper() == 'B' else 'White'
+    masks = {'W': 0, 'B': 0}
+    kings = 0
+    for field in fields[1:]:
+        if not field or field[0].upper() not in masks:
+            raise ValueError("Bad piece field %r in %r." % (field, fen))
+        side = field[0].upper()
+        for square in field[1:].split(','):
+            square = square.strip()
+            if not square:
+                continue
+            number = square.lstrip('Kk')
+            if not number.isdigit() or not 1 <= int(number) <= 32:
+                raise ValueError("Bad square %r in %r." % (square, fen))
+            bit = 1 << (int(number) - 1)
+            if (masks['B'] | masks['W']) & bit:
+                raise ValueError("Square %s is given twice in %r." % (number, fen))
+            masks[side] |= bit
+            if square[0] in 'Kk':
+                kings |= bit
+    return BitBoard(masks['B'], masks['W'], kings), color
+
+
+def move_notation(path):
+    # "9-13" for a simple move, "9x18x25" for a jump, with the square numbers
+    # of position_fen
+    squares = [str(SQUARE_INDEX[tuple(pos)] + 1) for pos in path]
+    jump = abs(path[1][0] - path[0][0]) == 2
+    return ('x' if jump else '-').join(squares)
+
+
+def find_move(board, color, text):
+    # The legal move written as text in move_notation, or None
+    for move in generate_moves(board, color):
+        if move_notation(move.path) == text.strip():
+            return move
+    return None
+
+
 #%% Evaluation functions
-def evaluate1(board, color):
+def scan_features(board):
+    # Full recount over the 64 squares, the reference for the running features
+    length = board.get_len()
     b, B, w, W = 0, 0, 0, 0
-    for (x, y) in board.black_position:
-        if board.get(x, y).king:
-            B += 1
-        else:
-            b += 1
+    bkd, wkd = 0, 0
+    bsd, wsd = 0, 0
+    bc, wc = 0, 0
+    for row in range(length):
+        for col in range(length):
+            piece = board.get(row, col)
+            if piece:
+                if piece.color == 'Black':
+                    bc += len(check_jump(board, row, col))
+                    if piece.is_king():
+                        B += 1
+                    else:
+                        b += 1
+                        bkd += row + 1
+                        bsd += SAFE_DISTANCE[row][col]
+                else:
+                    wc += len(check_jump(board, row, col))
+                    if piece.is_king():
+                        W += 1
+                    else:
+                        w += 1
+                        wkd += length - (row + 1)
+                        wsd += SAFE_DISTANCE[row][col]
+    return (b, B, w, W), (bkd, wkd), (bsd, wsd), (bc, wc)
 
-    for (x, y) in board.white_position:
-        if board.get(x, y).king:
-            W += 1
-        else:
-            w += 1
+
+def check_features(board):
+    features = (board.piece_counts(), board.king_distances(), board.safe_distances(), board.jump_counts())
+    assert features == scan_features(board), (features, scan_features(board))
+
+
+def evaluate1(board, color):
+    if CHECK_INCREMENTAL:
+        check_features(board)
+    b, B, w, W = board.piece_counts()
 
     if color == 'Black':
         if w+W == 0:
@@ -316,37 +947,14 @@ def evaluate2(board, color):
 
 
 def evaluate3(board, color):
-    length = board.get_len()
-    bp, wp = 0, 0
-    bk, wk = 0, 0
-    bc, wc = 0, 0
-    bkd, wkd = 0, 0
-    bsd, wsd = 0.0, 0.0
-    for row in range(length):
-        for col in range(length):
-            piece = board.get(row, col)
-            if piece:
-                r = row if row > (length - (row + 1)) else (length - (row + 1))
-                c = col if col > (length - (col + 1)) else (length - (col + 1))
-                d = int(((r ** 2.0 + c ** 2.0) ** 0.5) / 2.0)
-                if piece.color == 'Black':
-                    bc += sum([len(v) for v in \
-                               check_jump(board, row, col)])
-                    if piece.is_king():
-                        bk += 1
-                    else:
-                        bp += 1
-                        bkd += row + 1
-                        bsd += d
-                else:
-                    wc += sum([len(v) for v in \
-                               check_jump(board, row, col)])
-                    if piece.is_king():
-                        wk += 1
-                    else:
-                        wp += 1
-                        wkd += length - (row + 1)
-                        wsd += d
+    if CHECK_INCREMENTAL:
+        check_features(board)
+    bp, bk, wp, wk = board.piece_counts()
+    bkd, wkd = board.king_distances()
+    bsd, wsd = board.safe_distances()
+    bc, wc = board.jump_counts()
+    # check_jump returns (dx, dy) pairs, which the full scan used to count as two each
+    bc, wc = 2 * bc, 2 * wc
     if color == 'Black':
         b_c = 3.125 * (((bp + bk * 2.0) - (wp + wk * 2.0)) + ((bp + bk * 2.0) + (wp + wk * 2.0)))
         black_capture_heuristics = 1.0417 * ((bc - wc) / (1.0 + bc + wc))
@@ -365,6 +973,63 @@ def evaluate3(board, color):
                + white_kingdist_heuristics + white_safe_heuristics
 
 
+# Features of the tuned evaluation, from Black's side. Their weights come from
+# tuning.py through the weights file, read on first use.
+TUNED_FEATURES = ['men', 'kings', 'jumps', 'king_distance', 'safe_distance', 'back_rank', 'center']
+DEFAULT_WEIGHTS = (1.0, 2.0, 0.167, 0.229, 0.842, 0.0, 0.0)
+WEIGHTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights.json')
+BIT_CENTER = BIT_ROWS[3] | BIT_ROWS[4]
+_weights = []
+
+
+def load_weights(path=WEIGHTS_PATH):
+    # Replaces the weights of evaluate4. Transposition tables filled with the
+    # old weights should be cleared.
+    with open(path) as f:
+        data = json.load(f)
+    if data['features'] != TUNED_FEATURES:
+        raise ValueError("%s has weights for the features %s." % (path, data['features']))
+    _weights[:] = [float(w) for w in data['weights']]
+    return tuple(_weights)
+
+
+def current_weights():
+    if not _weights:
+        if os.path.exists(WEIGHTS_PATH):
+            load_weights()
+        else:
+            _weights[:] = DEFAULT_WEIGHTS
+    return _weights
+
+
+def tuned_features(board):
+    bp, bk, wp, wk = board.piece_counts()
+    bkd, wkd = board.king_distances()
+    bsd, wsd = board.safe_distances()
+    bc, wc = board.jump_counts()
+    black, white, kings = position_masks(board)
+    return (bp - wp, bk - wk, (bc - wc) / (1.0 + bc + wc), (bkd - wkd) / (1.0 + bkd + wkd),
+            (bsd - wsd) / (1.0 + bsd + wsd),
+            bit_count(black & ~kings & BIT_ROWS[0]) - bit_count(white & ~kings & BIT_ROWS[7]),
+            bit_count(black & BIT_CENTER) - bit_count(white & BIT_CENTER))
+
+
+def evaluate4(board, color):
+    v = 0.0
+    for weight, feature in zip(current_weights(), tuned_features(board)):
+        v += weight * feature
+    return v if color == 'Black' else -v
+
+
+def draw_score(board, type=0):
+    # What each heuristic gives a balanced position: no material difference,
+    # and for evaluate3 the total material term it always adds
+    if type == 2:
+        bp, bk, wp, wk = board.piece_counts()
+        return 3.125 * ((bp + bk * 2.0) + (wp + wk * 2.0))
+    return 0.0
+
+
 def evaluate(board, color, type=0):
     if type == 0:
         return evaluate1(board, color) + evaluate2(board, color)*0.01
@@ -373,46 +1038,936 @@ def evaluate(board, color, type=0):
         return evaluate1(board, color) + evaluate2(board, color)*0.01
     elif type == 2:
         return evaluate3(board, color)
+    elif type == 3:
+        return evaluate4(board, color)
+    raise ValueError("Unknown heuristic type %r." % (type,))
+
+
+# The heuristic types evaluate knows
+HEURISTIC_TYPES = (0, 1, 2, 3)
+
+
+#%% Batch evaluation
+# Positions are packed as N x 32 int8 arrays over the dark squares:
+# 1 black man, 2 black king, -1 white man, -2 white king, 0 empty.
+SQUARE_ROW = np.array([r for (r, c) in INDEX_SQUARE])
+SQUARE_COL = np.array([c for (r, c) in INDEX_SQUARE])
+SQUARE_DIST2 = (SQUARE_ROW[:, None] - SQUARE_ROW[None, :]) ** 2 + (SQUARE_COL[:, None] - SQUARE_COL[None, :]) ** 2
+SQUARE_SAFE = np.array([SAFE_DISTANCE[r][c] for (r, c) in INDEX_SQUARE])
+# Middle and landing square of a jump in each direction, 32 when off the board
+JUMP_DIRECTIONS = [(+1, -1), (+1, +1), (-1, -1), (-1, +1)]
+JUMP_MID = np.array([[SQUARE_INDEX.get((r + x, c + y), 32) if (r + 2 * x, c + 2 * y) in SQUARE_INDEX else 32
+                      for (r, c) in INDEX_SQUARE] for (x, y) in JUMP_DIRECTIONS])
+JUMP_LAND = np.array([[SQUARE_INDEX.get((r + 2 * x, c + 2 * y), 32) for (r, c) in INDEX_SQUARE]
+                      for (x, y) in JUMP_DIRECTIONS])
+JUMP_OFF_BOARD = 100
+
+
+def position_masks(board):
+    if isinstance(board, BitBoard):
+        return board.black, board.white, board.kings
+    black, white, kings = 0, 0, 0
+    for (r, c) in board.black_position:
+        black |= 1 << SQUARE_INDEX[(r, c)]
+    for (r, c) in board.white_position:
+        white |= 1 << SQUARE_INDEX[(r, c)]
+    for (r, c) in board.black_position + board.white_position:
+        if board.get(r, c).king:
+            kings |= 1 << SQUARE_INDEX[(r, c)]
+    return black, white, kings
+
+
+def encode_masks(masks):
+    masks = np.asarray(masks, dtype=np.int64).reshape(-1, 3)
+    bits = (masks[:, :, None] >> np.arange(32)) & 1
+    king = 1 + bits[:, 2]
+    return (bits[:, 0] * king - bits[:, 1] * king).astype(np.int8)
+
+
+def encode_positions(boards):
+    return encode_masks([position_masks(board) for board in boards])
+
+
+def _batch_counts(encoded):
+    return (encoded == 1).sum(1), (encoded == 2).sum(1), (encoded == -1).sum(1), (encoded == -2).sum(1)
+
+
+def batch_evaluate1(encoded, color):
+    b, B, w, W = _batch_counts(encoded)
+    if color == 'Black':
+        own_men, own_kings, op_men, op_kings = b, B, w, W
+    else:
+        own_men, own_kings, op_men, op_kings = w, W, b, B
+    with np.errstate(divide='ignore', invalid='ignore'):
+        e1 = ((own_men + own_kings * 1.5) - (op_men + op_kings * 1.5)) / (b + B + w + W)
+    return np.where(op_men + op_kings == 0, float('inf'), e1)
+
+
+def batch_evaluate2(encoded, color):
+    own, op = (encoded > 0, encoded < 0) if color == 'Black' else (encoded < 0, encoded > 0)
+    nearest = np.where(op[:, None, :], SQUARE_DIST2[None, :, :], np.iinfo(np.int64).max).min(2)
+    min_dis = np.where(own, nearest, 0).sum(1)
+    return np.where(op.any(1), 1 - min_dis / 49 / 2, float('inf'))
+
+
+def _batch_jumps(encoded):
+    # Jumps open to each side, as in jump_counts
+    black_men, black_kings = encoded == 1, encoded == 2
+    white_men, white_kings = encoded == -1, encoded == -2
+    padded = np.concatenate([encoded, np.full((encoded.shape[0], 1), JUMP_OFF_BOARD, dtype=np.int8)], 1)
+    bc, wc = 0, 0
+    for k, (x, y) in enumerate(JUMP_DIRECTIONS):
+        mid = padded[:, JUMP_MID[k]]
+        free = padded[:, JUMP_LAND[k]] == 0
+        bc = bc + ((black_kings | (black_men & (x == +1))) & (mid < 0) & free).sum(1)
+        wc = wc + ((white_kings | (white_men & (x == -1))) & (mid > 0) & (mid != JUMP_OFF_BOARD) & free).sum(1)
+    return bc, wc
+
+
+def batch_evaluate3(encoded, color):
+    black_men, black_kings = encoded == 1, encoded == 2
+    white_men, white_kings = encoded == -1, encoded == -2
+    bp, bk, wp, wk = black_men.sum(1), black_kings.sum(1), white_men.sum(1), white_kings.sum(1)
+    bc, wc = _batch_jumps(encoded)
+    # check_jump returns (dx, dy) pairs, so evaluate3 counts two per jump
+    bc, wc = 2 * bc, 2 * wc
+    bkd = (black_men * (SQUARE_ROW + 1)).sum(1)
+    wkd = (white_men * (7 - SQUARE_ROW)).sum(1)
+    bsd = (black_men * SQUARE_SAFE).sum(1).astype(float)
+    wsd = (white_men * SQUARE_SAFE).sum(1).astype(float)
+    if color == 'Black':
+        return 3.125 * (((bp + bk * 2.0) - (wp + wk * 2.0)) + ((bp + bk * 2.0) + (wp + wk * 2.0))) \
+            + 1.0417 * ((bc - wc) / (1.0 + bc + wc)) \
+            + 1.429 * ((bkd - wkd) / (1.0 + bkd + wkd)) \
+            + 5.263 * ((bsd - wsd) / (1.0 + bsd + wsd))
+    else:
+        return 3.125 * (((wp + wk * 2.0) - (bp + bk * 2.0)) / 1.0 + ((bp + bk * 2.0) + (wp + wk * 2.0))) \
+            + 1.0416 * ((wc - bc) / (1.0 + bc + wc)) \
+            + 1.428 * ((wkd - bkd) / (1.0 + bkd + wkd)) \
+            + 5.263 * ((wsd - bsd) / (1.0 + bsd + wsd))
+
+
+def batch_features(encoded):
+    # tuned_features of every packed position, as an N x 7 array
+    encoded = np.asarray(encoded, dtype=np.int8)
+    black_men, black_kings = encoded == 1, encoded == 2
+    white_men, white_kings = encoded == -1, encoded == -2
+    bc, wc = _batch_jumps(encoded)
+    bkd = (black_men * (SQUARE_ROW + 1)).sum(1)
+    wkd = (white_men * (7 - SQUARE_ROW)).sum(1)
+    bsd = (black_men * SQUARE_SAFE).sum(1)
+    wsd = (white_men * SQUARE_SAFE).sum(1)
+    center = (SQUARE_ROW == 3) | (SQUARE_ROW == 4)
+    return np.stack([black_men.sum(1) - white_men.sum(1), black_kings.sum(1) - white_kings.sum(1),
+                     (bc - wc) / (1.0 + bc + wc), (bkd - wkd) / (1.0 + bkd + wkd), (bsd - wsd) / (1.0 + bsd + wsd),
+                     (black_men & (SQUARE_ROW == 0)).sum(1) - (white_men & (SQUARE_ROW == 7)).sum(1),
+                     ((encoded > 0) & center).sum(1) - ((encoded < 0) & center).sum(1)], 1).astype(float)
+
+
+def batch_evaluate4(encoded, color):
+    v = batch_features(encoded) @ np.array(current_weights())
+    return v if color == 'Black' else -v
+
+
+def batch_heuristics(encoded, color):
+    # Columns are evaluate1, evaluate2 and evaluate3 for every packed position
+    encoded = np.asarray(encoded, dtype=np.int8)
+    return np.stack([batch_evaluate1(encoded, color), batch_evaluate2(encoded, color),
+                     batch_evaluate3(encoded, color)], 1)
+
+
+def evaluate_batch(encoded, color, type=0):
+    encoded = np.asarray(encoded, dtype=np.int8)
+    if type == 2:
+        return batch_evaluate3(encoded, color)
+    if type == 3:
+        return batch_evaluate4(encoded, color)
+    return batch_evaluate1(encoded, color) + batch_evaluate2(encoded, color) * 0.01
+
+
+#%% Transposition table
+TT_EXACT, TT_LOWER, TT_UPPER = 0, 1, 2
+TTEntry = namedtuple('TTEntry', ['key', 'depth', 'score', 'flag', 'move', 'generation'])
+
+
+class TranspositionTable(object):
+    # Cost of one filled slot, measured with tracemalloc over depth 7 searches:
+    # about 300 bytes for the entry tuple, its key and score objects and the
+    # Move it keeps alive (path tuples included), plus the list slot. The
+    # slot count is rounded down to a power of two, so size_mb is an upper bound.
+    entry_bytes = 320
+
+    def __init__(self, size_mb=16):
+        entries = max(1, int(size_mb * 2 ** 20) // self.entry_bytes)
+        self.size = 1 << (entries.bit_length() - 1)
+        self.mask = self.size - 1
+        self.table = [None] * self.size
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    def clear(self):
+        self.table = [None] * self.size
+        self.generation = 0
+
+    def probe(self, key):
+        entry = self.table[key & self.mask]
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.key != key:
+            self.misses += 1
+            self.collisions += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def store(self, key, depth, score, flag, move=None):
+        index = key & self.mask
+        entry = self.table[index]
+        # Depth-preferred replacement, but entries left over from earlier
+        # searches and entries for the same position are always overwritten.
+        if entry is not None:
+            if entry.key == key:
+                if move is None:
+                    move = entry.move
+            elif entry.generation == self.generation and entry.depth > depth:
+                return
+            else:
+                self.replacements += 1
+        self.stores += 1
+        self.table[index] = TTEntry(key, depth, score, flag, move, self.generation)
+
+    def stats(self):
+        used = sum(1 for entry in self.table if entry is not None)
+        return {'size': self.size, 'used': used, 'hits': self.hits, 'misses': self.misses,
+                'collisions': self.collisions, 'stores': self.stores, 'replacements': self.replacements}
 
 
 #%% Alpha-Beta agent
-def alpha_beta_search(board, agent_color, maxdepth=float('inf'), heuristic_type=0):
-    def max_value(board, color, alpha, beta, depth=1, maxdepth=float('inf')):
-        if depth >= maxdepth or is_over(board, color):
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchLimits(object):
+    def __init__(self, time_limit_ms=None, node_limit=None):
+        self.deadline = None if time_limit_ms is None else time.perf_counter() + time_limit_ms / 1000.0
+        self.node_limit = node_limit
+        self.nodes = 0
+        self.stopped = False
+
+    def stop(self):
+        # Can be called from another thread to end the search
+        self.stopped = True
+
+    def expired(self):
+        return self.stopped or (self.node_limit is not None and self.nodes >= self.node_limit) \
+            or (self.deadline is not None and time.perf_counter() >= self.deadline)
+
+    def tick(self):
+        self.nodes += 1
+        # the clock and the stop flag are only read every 64 nodes
+        if (self.node_limit is not None and self.nodes > self.node_limit) \
+                or (self.nodes & 63 == 0 and (self.stopped or (self.deadline is not None
+                                                               and time.perf_counter() >= self.deadline))):
+            raise SearchTimeout()
+
+
+class SearchStats(object):
+    # Filled in by the searches it is passed to; one object may collect
+    # several searches (e.g. all iterations of iterative deepening).
+    def __init__(self):
+        self.nodes = 0
+        self.leaves = 0
+        self.interior = 0
+        self.quiescence_nodes = 0
+        # PVS scouts that failed high, aspiration windows that failed
+        self.researches = 0
+        self.aspiration_fails = 0
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.ply_cutoffs = {}
+        self.root_nodes = {}
+        # seconds spent generating moves, testing for game over and evaluating
+        self.times = {'generate': 0.0, 'is_over': 0.0, 'evaluate': 0.0}
+        self.elapsed = 0.0
+        self.depth = 0
+        self.score = None
+        self.pv = []
+
+    def cutoff_rate(self):
+        return self.cutoffs / self.interior if self.interior else 0.0
+
+    def first_move_rate(self):
+        return self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0.0
+
+    def nps(self):
+        return self.nodes / self.elapsed if self.elapsed else 0.0
+
+    def branching_factor(self):
+        # Effective branching factor: the b with b ** depth == nodes
+        return self.nodes ** (1.0 / self.depth) if self.depth and self.nodes else 0.0
+
+    def merge(self, other):
+        self.nodes += other.nodes
+        self.leaves += other.leaves
+        self.interior += other.interior
+        self.quiescence_nodes += other.quiescence_nodes
+        self.researches += other.researches
+        self.aspiration_fails += other.aspiration_fails
+        self.cutoffs += other.cutoffs
+        self.first_move_cutoffs += other.first_move_cutoffs
+        for ply, count in other.ply_cutoffs.items():
+            self.ply_cutoffs[ply] = self.ply_cutoffs.get(ply, 0) + count
+        for path, count in other.root_nodes.items():
+            self.root_nodes[path] = self.root_nodes.get(path, 0) + count
+        for name, seconds in other.times.items():
+            self.times[name] += seconds
+
+    def to_dict(self):
+        return {'nodes': self.nodes, 'leaves': self.leaves, 'interior': self.interior,
+                'quiescence_nodes': self.quiescence_nodes, 'researches': self.researches,
+                'aspiration_fails': self.aspiration_fails,
+                'cutoffs': self.cutoffs, 'first_move_cutoffs': self.first_move_cutoffs,
+                'ply_cutoffs': {str(ply): count for ply, count in sorted(self.ply_cutoffs.items())},
+                'root_nodes': [[[list(pos) for pos in path], count] for path, count in self.root_nodes.items()],
+                'times': self.times, 'elapsed': self.elapsed, 'nps': self.nps(), 'depth': self.depth,
+                'branching_factor': self.branching_factor(), 'score': self.score,
+                'pv': [[list(pos) for pos in move.path] for move in self.pv]}
+
+    def export(self, path, **fields):
+        # Appends the stats, plus any extra fields, as one json line
+        record = self.to_dict()
+        record.update(fields)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def __str__(self):
+        return 'nodes: %d, cutoff rate: %.3f, first move cutoffs: %.3f' \
+               % (self.nodes, self.cutoff_rate(), self.first_move_rate())
+
+
+class MoveOrdering(object):
+    # Hash move first, then longer captures, promotions, the killer moves of
+    # the ply and finally the history score. Generation order breaks ties.
+    def __init__(self, killers_per_ply=2):
+        self.killers_per_ply = killers_per_ply
+        self.killers = {}
+        self.history = {}
+
+    def clear(self):
+        self.killers = {}
+        self.history = {}
+
+    def order(self, moves, ply, color, hash_move=None):
+        killers = self.killers.get(ply, [])
+        history = self.history
+
+        def key(move):
+            if move == hash_move:
+                return 1 << 40
+            score = len(move.captured) << 30
+            if move.promote:
+                score += 1 << 29
+            if move in killers:
+                score += (1 << 28) >> killers.index(move)
+            return score + min(history.get((color, move.start, move.end), 0), (1 << 27) - 1)
+        return sorted(moves, key=key, reverse=True)
+
+    def cutoff(self, move, ply, color, remaining):
+        if not move.captured:
+            killers = self.killers.setdefault(ply, [])
+            if move in killers:
+                killers.remove(move)
+            killers.insert(0, move)
+            del killers[self.killers_per_ply:]
+        remaining = min(remaining, 32)
+        key = (color, move.start, move.end)
+        self.history[key] = self.history.get(key, 0) + remaining * remaining
+
+
+# Score of a proven win, minus the plies it takes
+WIN_SCORE = 1e6
+# Default capture extension past the nominal depth, in plies and in nodes
+# below each leaf
+QUIESCENCE_PLIES = 8
+QUIESCENCE_NODES = 500
+# Width of the null window of PVS scout searches. Any value inside it is
+# exact, so it only has to be smaller than the gaps between scores.
+SCOUT_WINDOW = 1e-6
+# Aspiration half widths per heuristic type, in the units of its scores
+ASPIRATION_WINDOW = {0: 0.25, 1: 0.25, 2: 1.0, 3: 0.25}
+
+
+def score_to_tt(score, ply):
+    # Win scores count the plies from the root; the table keeps them counted
+    # from the stored node, so they stay right at any ply and in later searches
+    if score >= WIN_SCORE / 2:
+        return score + ply
+    if score <= -WIN_SCORE / 2:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score >= WIN_SCORE / 2:
+        return score - ply
+    if score <= -WIN_SCORE / 2:
+        return score + ply
+    return score
+
+
+def search_key(board, color, agent_color, heuristic_type):
+    return board.zobrist ^ ZOBRIST_TURN[color] ^ ZOBRIST_AGENT[agent_color] ^ ZOBRIST_HEURISTIC[heuristic_type]
+
+
+def order_moves(moves, color, hash_move=None, ply=0, ordering=None):
+    if ordering is not None:
+        return ordering.order(moves, ply, color, hash_move)
+    if hash_move in moves:
+        moves.remove(hash_move)
+        moves.insert(0, hash_move)
+    return moves
+
+
+def search_root(board, agent_color, moves, alpha=-float('inf'), beta=float('inf'), maxdepth=float('inf'),
+                heuristic_type=0, tt=None, limits=None, ordering=None, stats=None, batch_leaves=False,
+                tablebase=None, quiescence=0, quiescence_nodes=None, pvs=False, history=None, draws=None):
+    # Searches the given root moves in order on board, in place. Returns the
+    # first move scoring above alpha with the highest score, or (None, alpha).
+    # history lists the game_key of the positions before the root that can
+    # come up again; with it, a position repeating one of them or one on the
+    # path from the root is scored as a draw. Such a score depends on the path,
+    # so no node above one is stored in tt; draws, a one item list, counts them.
+    # Past maxdepth, positions with a capture pending are searched on (captures
+    # only, as they are forced) for up to quiescence more plies and
+    # quiescence_nodes nodes below each leaf. With pvs, every move after the
+    # first is tried with a null window and searched again if it fails high.
+    salt = ZOBRIST_AGENT[agent_color] ^ ZOBRIST_HEURISTIC[heuristic_type]
+    seen = None
+    draws = [0] if draws is None else draws
+    if history is not None:
+        seen = set(history)
+        seen.add(game_key(board, agent_color))
+
+    def probe(board, color, alpha, beta, depth, maxdepth):
+        # Returns (cutoff score or None, hash move or None)
+        if tt is None:
+            return None, None
+        entry = tt.probe(board.zobrist ^ ZOBRIST_TURN[color] ^ salt)
+        if entry is None:
+            return None, None
+        if entry.depth >= maxdepth - depth:
+            score = score_from_tt(entry.score, depth)
+            if entry.flag == TT_EXACT \
+                    or (entry.flag == TT_LOWER and score >= beta) \
+                    or (entry.flag == TT_UPPER and score <= alpha):
+                return score, entry.move
+        return None, entry.move
+
+    def store(board, color, alpha, beta, depth, maxdepth, v, move):
+        if tt is None:
+            return
+        if v <= alpha:
+            flag = TT_UPPER
+        elif v >= beta:
+            flag = TT_LOWER
+        else:
+            flag = TT_EXACT
+        tt.store(board.zobrist ^ ZOBRIST_TURN[color] ^ salt, maxdepth - depth, score_to_tt(v, depth), flag, move)
+
+    def lost_score(color, depth):
+        # The side to move cannot move and has lost; quicker wins score higher
+        return -(WIN_SCORE - depth) if color == agent_color else WIN_SCORE - depth
+
+    def tablebase_score(board, color, depth):
+        result = tablebase.probe(board, color)
+        if result is None:
+            return None
+        outcome, distance = result
+        if outcome == 'draw':
+            return draw_score(board, heuristic_type)
+        score = WIN_SCORE - (depth + distance)
+        return score if (outcome == 'win') == (color == agent_color) else -score
+
+    def ordered_moves(board, color, hash_move, depth):
+        if stats is None:
+            return order_moves(generate_moves(board, color), color, hash_move, depth, ordering)
+        start = time.perf_counter()
+        moves = generate_moves(board, color)
+        stats.times['generate'] += time.perf_counter() - start
+        return order_moves(moves, color, hash_move, depth, ordering)
+
+    def streamed_moves(board, color):
+        # Moves in generation order, timed move by move
+        moves = iter_moves(board, color)
+        while True:
+            start = time.perf_counter()
+            move = next(moves, None)
+            stats.times['generate'] += time.perf_counter() - start
+            if move is None:
+                return
+            yield move
+
+    def staged_moves(board, color, hash_move, depth):
+        # The hash move is tried before the other moves are generated, and
+        # without move ordering the rest is generated only as it is searched
+        if hash_move is None or not is_legal(board, color, hash_move):
+            hash_move = None
+        else:
+            yield hash_move
+        if ordering is not None:
+            moves = ordered_moves(board, color, None, depth)
+        elif stats is None:
+            moves = iter_moves(board, color)
+        else:
+            moves = streamed_moves(board, color)
+        for move in moves:
+            if move != hash_move:
+                yield move
+
+    def node_moves(board, color, hash_move, depth, maxdepth):
+        # Moves of an interior node, or None when there are none. They are
+        # all generated up front only if the children are scored together.
+        if batch_leaves and depth + 1 >= maxdepth:
+            return ordered_moves(board, color, hash_move, depth) or None
+        moves = staged_moves(board, color, hash_move, depth)
+        first = next(moves, None)
+        return None if first is None else itertools.chain((first,), moves)
+
+    def game_over(board, color):
+        if stats is None:
+            return not board.has_moves(color)
+        start = time.perf_counter()
+        over = not board.has_moves(color)
+        stats.times['is_over'] += time.perf_counter() - start
+        return over
+
+    budget = [0]
+
+    def quiet(board, color, depth, maxdepth):
+        # Whether a node at or past the depth limit is scored statically
+        if depth >= maxdepth + quiescence or not board.has_jumps(color):
+            return True
+        if depth == maxdepth:
+            budget[0] = quiescence_nodes
+        elif budget[0] is not None:
+            budget[0] -= 1
+            if budget[0] < 0:
+                return True
+        if stats is not None:
+            stats.quiescence_nodes += 1
+        return False
+
+    def leaf(board, color, depth):
+        # Static score of a node at the depth limit
+        if game_over(board, color):
+            return lost_score(color, depth)
+        if stats is None:
             return evaluate(board, agent_color, heuristic_type)
+        start = time.perf_counter()
+        v = evaluate(board, agent_color, heuristic_type)
+        stats.times['evaluate'] += time.perf_counter() - start
+        return v
+
+    def leaf_values(board, moves, depth, maxdepth):
+        # Scores all children together when they are all leaves. Children
+        # left as None have a capture pending and are searched on.
+        if not batch_leaves or depth + 1 < maxdepth or not moves:
+            return None
+        if stats is not None:
+            start = time.perf_counter()
+        color = another_color(agent_color) if depth % 2 == 0 else agent_color
+        values = [None] * len(moves)
+        static = []
+        masks = []
+        for i, move in enumerate(moves):
+            undo = board.apply_move(move)
+            if seen is not None and game_key(board, color) in seen:
+                draws[0] += 1
+                values[i] = draw_score(board, heuristic_type)
+            if values[i] is None and tablebase is not None:
+                values[i] = tablebase_score(board, color, depth + 1)
+            if values[i] is None and not board.has_moves(color):
+                values[i] = lost_score(color, depth + 1)
+            if values[i] is None and (quiescence == 0 or depth + 1 >= maxdepth + quiescence
+                                      or not board.has_jumps(color)):
+                static.append(i)
+                masks.append(position_masks(board))
+            board.undo_move(move, undo)
+        if masks:
+            for i, v in zip(static, evaluate_batch(encode_masks(masks), agent_color, heuristic_type).tolist()):
+                values[i] = v
+        if stats is not None:
+            resolved = sum(1 for v in values if v is not None)
+            stats.nodes += resolved
+            stats.leaves += resolved
+            stats.times['evaluate'] += time.perf_counter() - start
+            lines[depth + 1] = []
+        return values
+
+    def cutoff(move, index, color, depth, maxdepth):
+        if stats is not None:
+            stats.cutoffs += 1
+            stats.ply_cutoffs[depth] = stats.ply_cutoffs.get(depth, 0) + 1
+            if index == 0:
+                stats.first_move_cutoffs += 1
+        if ordering is not None and depth < maxdepth:
+            ordering.cutoff(move, depth, color, maxdepth - depth)
+
+    def search_child(board, move, index, color, alpha, beta, depth, maxdepth):
+        other = another_color(color)
+        undo = board.apply_move(move)
+        if seen is None:
+            value = search_window(board, index, color, alpha, beta, depth, maxdepth)
+        else:
+            key = game_key(board, other)
+            if key in seen:
+                if stats is not None:
+                    stats.nodes += 1
+                    stats.leaves += 1
+                    lines[depth + 1] = []
+                draws[0] += 1
+                value = draw_score(board, heuristic_type)
+            else:
+                seen.add(key)
+                value = search_window(board, index, color, alpha, beta, depth, maxdepth)
+                seen.discard(key)
+        board.undo_move(move, undo)
+        return value
+
+    def search_window(board, index, color, alpha, beta, depth, maxdepth):
+        # Searches the child already on board, with a null window first under pvs
+        child = min_value if color == agent_color else max_value
+        other = another_color(color)
+        if pvs and index > 0 and color == agent_color and -float('inf') < alpha < beta - SCOUT_WINDOW:
+            value = child(board, other, alpha, alpha + SCOUT_WINDOW, depth + 1, maxdepth)
+            if alpha + SCOUT_WINDOW <= value < beta:
+                if stats is not None:
+                    stats.researches += 1
+                value = child(board, other, alpha, beta, depth + 1, maxdepth)
+        elif pvs and index > 0 and color != agent_color and alpha + SCOUT_WINDOW < beta < float('inf'):
+            value = child(board, other, beta - SCOUT_WINDOW, beta, depth + 1, maxdepth)
+            if alpha < value <= beta - SCOUT_WINDOW:
+                if stats is not None:
+                    stats.researches += 1
+                value = child(board, other, alpha, beta, depth + 1, maxdepth)
+        else:
+            value = child(board, other, alpha, beta, depth + 1, maxdepth)
+        return value
+
+    # Principal variation below each ply, only kept when collecting stats
+    lines = {}
+
+    def max_value(board, color, alpha, beta, depth=1, maxdepth=float('inf')):
+        if limits is not None:
+            limits.tick()
+        if stats is not None:
+            stats.nodes += 1
+            lines[depth] = []
+        if tablebase is not None:
+            score = tablebase_score(board, color, depth)
+            if score is not None:
+                if stats is not None:
+                    stats.leaves += 1
+                return score
+        if depth >= maxdepth and quiet(board, color, depth, maxdepth):
+            if stats is not None:
+                stats.leaves += 1
+            return leaf(board, color, depth)
+        # quiescence nodes skip the transposition table
+        score, hash_move = probe(board, color, alpha, beta, depth, maxdepth) if depth < maxdepth else (None, None)
+        if score is not None:
+            return score
+        moves = node_moves(board, color, hash_move, depth, maxdepth)
+        if moves is None:
+            if stats is not None:
+                stats.leaves += 1
+            return lost_score(color, depth)
+        if stats is not None:
+            stats.interior += 1
+        alpha_orig = alpha
+        repetitions = draws[0]
         v = -float('inf')
-        moves_all, results_all = all_moves_color(board, color)
-        for result in results_all:
-            v = max(v, min_value(result, another_color(color), alpha, beta, depth+1, maxdepth))
+        best_move = None
+        values = leaf_values(board, moves, depth, maxdepth)
+        for i, move in enumerate(moves):
+            if values is not None and values[i] is not None:
+                value = values[i]
+            else:
+                value = search_child(board, move, i, color, alpha, beta, depth, maxdepth)
+            if value > v:
+                v = value
+                best_move = move
+                if stats is not None:
+                    lines[depth] = [move] + lines.get(depth + 1, [])
             if v >= beta:
-                return v
+                cutoff(move, i, color, depth, maxdepth)
+                break
             alpha = max(alpha, v)
+        if depth < maxdepth and draws[0] == repetitions:
+            store(board, color, alpha_orig, beta, depth, maxdepth, v, best_move)
         return v
 
     def min_value(board, color, alpha, beta, depth=1, maxdepth=float('inf')):
-        if depth >= maxdepth or is_over(board, color):
-            return evaluate(board, agent_color, heuristic_type)
+        if limits is not None:
+            limits.tick()
+        if stats is not None:
+            stats.nodes += 1
+            lines[depth] = []
+        if tablebase is not None:
+            score = tablebase_score(board, color, depth)
+            if score is not None:
+                if stats is not None:
+                    stats.leaves += 1
+                return score
+        if depth >= maxdepth and quiet(board, color, depth, maxdepth):
+            if stats is not None:
+                stats.leaves += 1
+            return leaf(board, color, depth)
+        # quiescence nodes skip the transposition table
+        score, hash_move = probe(board, color, alpha, beta, depth, maxdepth) if depth < maxdepth else (None, None)
+        if score is not None:
+            return score
+        moves = node_moves(board, color, hash_move, depth, maxdepth)
+        if moves is None:
+            if stats is not None:
+                stats.leaves += 1
+            return lost_score(color, depth)
+        if stats is not None:
+            stats.interior += 1
+        beta_orig = beta
+        repetitions = draws[0]
         v = float('inf')
-        moves_all, results_all = all_moves_color(board, color)
-        for result in results_all:
-            v = min(v, max_value(result, another_color(color), alpha, beta, depth+1, maxdepth))
+        best_move = None
+        values = leaf_values(board, moves, depth, maxdepth)
+        for i, move in enumerate(moves):
+            if values is not None and values[i] is not None:
+                value = values[i]
+            else:
+                value = search_child(board, move, i, color, alpha, beta, depth, maxdepth)
+            if value < v:
+                v = value
+                best_move = move
+                if stats is not None:
+                    lines[depth] = [move] + lines.get(depth + 1, [])
             if v <= alpha:
-                return v
+                cutoff(move, i, color, depth, maxdepth)
+                break
             beta = min(beta, v)
+        if depth < maxdepth and draws[0] == repetitions:
+            store(board, color, alpha, beta_orig, depth, maxdepth, v, best_move)
         return v
 
-    color = agent_color
-    best_score = -float('inf')
-    beta = float('inf')
-    best_action = None
-    best_result = None
-    moves_all, results_all = all_moves_color(board, color)
-    for i, result in enumerate(results_all):
-        v = min_value(result, another_color(color), best_score, beta, 1, maxdepth)
+    best_move = None
+    best_score = alpha
+    values = leaf_values(board, moves, 0, maxdepth)
+    for i, move in enumerate(moves):
+        if values is not None and values[i] is not None:
+            v = values[i]
+        else:
+            nodes = stats.nodes if stats is not None else 0
+            v = search_child(board, move, i, agent_color, best_score, beta, 0, maxdepth)
+            if stats is not None:
+                stats.root_nodes[move.path] = stats.root_nodes.get(move.path, 0) + stats.nodes - nodes
+        if v > best_score:
+            best_score = v
+            best_move = move
+            if stats is not None:
+                stats.pv = [move] + lines.get(1, [])
+    return best_move, best_score
+
+
+_process_pools = {}
+
+
+def process_pool(workers):
+    # Pools are kept for the life of the process so repeated searches do not
+    # pay for starting the workers again.
+    if workers not in _process_pools:
+        from concurrent.futures import ProcessPoolExecutor
+        _process_pools[workers] = ProcessPoolExecutor(workers)
+    return _process_pools[workers]
+
+
+def _search_root_move(board, agent_color, move, alpha, maxdepth, heuristic_type, time_limit_ms, node_limit, options):
+    # Returns (score or None on timeout, stats, nodes searched)
+    limits = SearchLimits(time_limit_ms, node_limit) if time_limit_ms is not None or node_limit is not None else None
+    stats = SearchStats()
+    try:
+        best_move, best_score = search_root(board, agent_color, [move], alpha, float('inf'), maxdepth,
+                                            heuristic_type, limits=limits, stats=stats, **options)
+    except SearchTimeout:
+        return None, stats, limits.nodes
+    return best_score, stats, limits.nodes if limits is not None else stats.nodes
+
+
+def parallel_search_root(board, agent_color, moves, maxdepth=float('inf'), heuristic_type=0, tt=None,
+                         limits=None, ordering=None, stats=None, workers=2, **options):
+    # Young-Brothers-Wait at the root: the eldest move is searched first to get
+    # alpha, then its brothers are searched in parallel against that fixed
+    # bound. Scores above alpha are exact, so taking the first maximum in move
+    # order gives the same move as search_root.
+    # At most workers brothers are out at once. Each gets the time left and
+    # an even share of the nodes left over the free workers, and its nodes
+    # count against limits when it returns; a stopped limits cancels the rest.
+    from concurrent.futures import FIRST_COMPLETED, wait
+    best_move, best_score = search_root(board, agent_color, moves[:1], -float('inf'), float('inf'), maxdepth,
+                                        heuristic_type, tt, limits, ordering, stats, **options)
+    if len(moves) == 1:
+        return best_move, best_score
+    pool = process_pool(workers)
+    waiting = list(enumerate(moves[1:]))
+    running = {}
+    results = {}
+    timed_out = False
+    while (waiting or running) and not timed_out:
+        while waiting and len(running) < workers:
+            time_limit_ms, node_limit = None, None
+            if limits is not None and limits.deadline is not None:
+                time_limit_ms = max(0.0, (limits.deadline - time.perf_counter()) * 1000.0)
+            if limits is not None and limits.node_limit is not None:
+                reserved = sum(budget for index, budget in running.values())
+                node_limit = max(0, (limits.node_limit - limits.nodes - reserved) // (workers - len(running)))
+            i, move = waiting.pop(0)
+            future = pool.submit(_search_root_move, board, agent_color, move, best_score, maxdepth,
+                                 heuristic_type, time_limit_ms, node_limit, options)
+            running[future] = (i, node_limit or 0)
+        done = wait(list(running), timeout=0.05, return_when=FIRST_COMPLETED)[0]
+        for future in done:
+            i, budget = running.pop(future)
+            v, move_stats, nodes = future.result()
+            if limits is not None:
+                limits.nodes += nodes
+            if stats is not None:
+                stats.merge(move_stats)
+            if v is None:
+                timed_out = True
+            results[i] = (v, move_stats)
+        if limits is not None and (waiting or running) and limits.expired():
+            timed_out = True
+    if timed_out:
+        for future in running:
+            future.cancel()
+        raise SearchTimeout()
+    for i, move in enumerate(moves[1:]):
+        v, move_stats = results[i]
         if v > best_score:
             best_score = v
-            best_action = moves_all[i]
-            best_result = copy.deepcopy(result)
+            best_move = move
+            if stats is not None:
+                stats.pv = move_stats.pv
+    return best_move, best_score
+
+
+def alpha_beta_search(board, agent_color, maxdepth=float('inf'), heuristic_type=0, tt=None,
+                      limits=None, root_move=None, ordering=None, stats=None, workers=1, batch_leaves=False,
+                      tablebase=None, quiescence=0, quiescence_nodes=None, pvs=False, aspiration=None,
+                      history=None):
+    # The tree is walked in place on a private copy, only the chosen child is materialized.
+    # With aspiration, the root is first searched with a window of that half
+    # width around the exact score left in tt by the previous iteration.
+    # The root is not stored when a repetition draw may be behind its score.
+    board = copy.deepcopy(board)
+    color = agent_color
+    moves = generate_moves(board, color)
+    hash_move = None
+    guess = None
+    if tt is not None:
+        tt.new_search()
+        entry = tt.probe(search_key(board, color, agent_color, heuristic_type))
+        if entry is not None:
+            hash_move = entry.move
+            if entry.flag == TT_EXACT and abs(entry.score) < WIN_SCORE / 2:
+                guess = entry.score
+    if root_move is not None:
+        for move in moves:
+            if list(move.path) == list(root_move):
+                hash_move = move
+    moves = order_moves(moves, color, hash_move, 0, ordering)
+    options = {'batch_leaves': batch_leaves, 'tablebase': tablebase, 'quiescence': quiescence,
+               'quiescence_nodes': quiescence_nodes, 'pvs': pvs, 'history': history}
+    # parallel brothers count their draws in their own process
+    draws = [0]
+    if workers <= 1:
+        options['draws'] = draws
+    start = time.perf_counter()
+    try:
+        best_move = None
+        if aspiration is not None and guess is not None and workers <= 1:
+            alpha, beta = guess - aspiration, guess + aspiration
+            best_move, best_score = search_root(board, agent_color, moves, alpha, beta, maxdepth,
+                                                heuristic_type, tt, limits, ordering, stats, **options)
+            if best_move is None or best_score >= beta:
+                if stats is not None:
+                    stats.aspiration_fails += 1
+                best_move = None
+        if best_move is None and workers > 1:
+            best_move, best_score = parallel_search_root(board, agent_color, moves, maxdepth, heuristic_type, tt,
+                                                         limits, ordering, stats, workers, **options)
+        elif best_move is None:
+            best_move, best_score = search_root(board, agent_color, moves, -float('inf'), float('inf'), maxdepth,
+                                                heuristic_type, tt, limits, ordering, stats, **options)
+    finally:
+        if stats is not None:
+            stats.elapsed += time.perf_counter() - start
+    if stats is not None:
+        stats.depth = maxdepth
+        stats.score = best_score
+    if best_move is None:
+        return None, None
+    if tt is not None and (history is None or (workers <= 1 and draws[0] == 0)):
+        tt.store(search_key(board, color, agent_color, heuristic_type), maxdepth, best_score, TT_EXACT, best_move)
+    return list(best_move.path), move_result(board, best_move)
+
+
+def iterative_deepening(board, agent_color, time_limit_ms=None, node_limit=None, maxdepth=float('inf'),
+                        heuristic_type=0, tt=None, ordering=None, stats=None, workers=1, batch_leaves=False,
+                        tablebase=None, quiescence=0, quiescence_nodes=None, pvs=False, aspiration=None,
+                        limits=None, report=None, history=None):
+    # limits, if given, replaces time_limit_ms and node_limit, e.g. to stop
+    # the search from another thread. report(depth, action) is called after
+    # every completed iteration. history is as in search_root.
+    if time_limit_ms is None and node_limit is None and maxdepth == float('inf') and limits is None:
+        raise ValueError("A time limit, a node limit or a maximum depth is needed.")
+    if tt is None:
+        tt = TranspositionTable()
+    if ordering is None:
+        ordering = MoveOrdering()
+    if limits is None:
+        limits = SearchLimits(time_limit_ms, node_limit)
+    best_action, best_result = None, None
+    pv = None
+    depth = 1
+    while depth <= maxdepth:
+        if stats is not None:
+            pv = stats.pv
+        try:
+            # depth 1 always completes so there is a move to return
+            action, result = alpha_beta_search(board, agent_color, depth, heuristic_type, tt,
+                                               limits if depth > 1 else None, best_action, ordering, stats, workers,
+                                               batch_leaves, tablebase, quiescence, quiescence_nodes, pvs,
+                                               aspiration, history)
+        except SearchTimeout:
+            if stats is not None:
+                # the unfinished iteration's line may not start with the move played
+                stats.pv = pv
+            break
+        if action is None:
+            # no legal move
+            break
+        best_action, best_result = action, result
+        if report is not None:
+            report(depth, action)
+        if limits.expired():
+            break
+        depth += 1
     return best_action, best_result
 
 
@@ -443,19 +1998,104 @@ def target_pos_valid(board, piece_position, target_position):
     return True
 
 
-def main_user():
+class Ponderer(object):
+    # Searches the agent's answer to every reply of the user in a background
+    # thread while the user is thinking, the predicted reply first. search is
+    # called as search(board, limits) and must give up with SearchTimeout
+    # once limits is stopped. Unfinished searches still leave their entries in
+    # the shared tables.
+    def __init__(self, search):
+        self.search = search
+        self.results = {}
+        self.limits = None
+        self.thread = None
+        self.stopped = False
+
+    def start(self, board, color, predicted=None):
+        import threading
+        moves = generate_moves(board, color)
+        if predicted in moves:
+            moves.remove(predicted)
+            moves.insert(0, predicted)
+        self.results = {}
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, args=(board, moves))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, board, moves):
+        for move in moves:
+            self.limits = SearchLimits()
+            if self.stopped:
+                break
+            try:
+                self.results[move.path] = self.search(move_result(board, move), self.limits)
+            except SearchTimeout:
+                break
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped = True
+            if self.limits is not None:
+                self.limits.stop()
+            self.thread.join()
+            self.thread = None
+
+    def result(self, path):
+        # (action, result) of the finished search after the user's move, or None
+        return self.results.get(tuple(tuple(pos) for pos in path))
+
+
+def main_user(time_limit_ms=None, tablebase_path='endgame.cktb', book_path='opening.ckbk', stats_path=None,
+              ponder=True):
     print("Game start! Let's get ready!")
     user_color = str(input('Please choose the color you want ((Black)/ White):'))
     if user_color not in ["Black", "White"]:
         user_color = "Black"
     agent_color = 'Black' if user_color == 'White' else 'White'
 
-    board = Board()
+    board = BitBoard()
     board.display()
+    tt = TranspositionTable(64)
+    ordering = MoveOrdering()
+    tablebase = None
+    if tablebase_path is not None and os.path.exists(tablebase_path):
+        from tablebase import Tablebase
+        tablebase = Tablebase(tablebase_path)
+    book = None
+    if book_path is not None and os.path.exists(book_path):
+        from book import Book
+        book = Book(book_path)
+
+    game = GameHistory(board, 'Black')
+
+    def search(board, color, stats=None, limits=None):
+        if time_limit_ms is None:
+            return alpha_beta_search(board, color, 7, tt=tt, limits=limits, ordering=ordering, stats=stats,
+                                     tablebase=tablebase, quiescence=QUIESCENCE_PLIES,
+                                     quiescence_nodes=QUIESCENCE_NODES, pvs=True, history=game.reversible())
+        if limits is not None:
+            # a pondering search stops at the move time, or earlier when stopped
+            limits.deadline = time.perf_counter() + time_limit_ms / 1000.0
+        action, result = iterative_deepening(board, color, time_limit_ms, tt=tt, ordering=ordering, stats=stats,
+                                             tablebase=tablebase, quiescence=QUIESCENCE_PLIES,
+                                             quiescence_nodes=QUIESCENCE_NODES, pvs=True,
+                                             aspiration=ASPIRATION_WINDOW[0], limits=limits,
+                                             history=game.reversible())
+        if limits is not None and limits.stopped:
+            # the last iteration was cut short, this is not the full answer
+            raise SearchTimeout()
+        return action, result
+    ponderer = Ponderer(lambda board, limits: search(board, agent_color, limits=limits)) if ponder else None
+    pondered = None
     color = "Black"
     steps = 1
-    while not is_over(board, color) and steps <= 100:
+    while not is_over(board, color) and game.draw() is None and steps <= 100:
+        previous = board
         if user_color == color:
+            if ponderer is not None:
+                entry = tt.probe(search_key(board, color, agent_color, 0))
+                ponderer.start(copy.deepcopy(board), color, entry.move if entry is not None else None)
             moves_all, results_all = all_moves_color(board, color)
             piece_valid = [position_trans(move[0]) for move in moves_all]
             target_valid = [position_trans(move[1]) for move in moves_all]
@@ -476,60 +2116,56 @@ def main_user():
                     move = moves_all[i]
             print("The move made is " + " -> ".join(position_trans(pos) for pos in move))
             board.display()
+            pondered = None
+            if ponderer is not None:
+                ponderer.stop()
+                pondered = ponderer.result(move)
         else:
             print("Please wait...")
-            best_action, best_result = alpha_beta_search(board, color, 7)
+            book_move = book.choose(board, color) if book is not None else None
+            stats = SearchStats() if stats_path is not None else None
+            if book_move is not None:
+                best_action, best_result = list(book_move.path), move_result(board, book_move)
+            elif pondered is not None:
+                # the answer was searched while the user was thinking
+                best_action, best_result = pondered
+            else:
+                best_action, best_result = search(board, color, stats)
+                if stats is not None:
+                    stats.export(stats_path, ply=steps, color=color)
+            pondered = None
             board = best_result
+            move = best_action
             print("The move made is " + " -> ".join(position_trans(pos) for pos in best_action))
             board.display()
 
         color = another_color(color)
+        game.push(board, color, is_progress(previous, move))
         steps += 1
-    print(color + " won!")
+    if is_over(board, color):
+        print(another_color(color) + " won!")
+    elif game.draw() is not None:
+        print("Draw by %s!" % game.draw())
+    else:
+        print("Draw!")
 
 
-def main_depth():
-    L = 6
-    res = np.zeros((L, L))
-    for i in range(1, L+1):
-        for j in range(1, L+1):
-            board = Board()
-            # board.display()
-            bb = board
-            color = 'Black'
-            n = 0
-            while n < 200:
-                n += 2
-                # time.sleep(0.5)
-                aa, bb = alpha_beta_search(bb, color, i, 1) #Black
-                if aa is None:
-                    break
-                # print([position_trans(pos) for pos in aa])
-                # bb.display()
-                # time.sleep(0.5)
-                color = another_color(color)
-                aa, bb = alpha_beta_search(bb, color, j, 1) #White
-                if aa is None:
-                    break
-                # print([position_trans(pos) for pos in aa])
-                # bb.display()
-                color = another_color(color)
-            if n == 200:
-                res[i-1, j-1] = -100
-            else:
-                if color == 'White':
-                    res[i-1, j-1] = 1
-                if color == 'Black':
-                    res[i-1, j-1] = 2
-            print(res)
-            # print(another_color(color) + " won!")
+def main_depth(checkpoint='compare_depth.jsonl', book_path='opening.ckbk', games='compare_depth.ckgr',
+               tablebase_path='endgame.cktb'):
+    import tournament
+    players = [tournament.Player('depth %d' % i, i, 1) for i in range(1, 7)]
+    pairings = [(a, b) for i, a in enumerate(players) for b in players[i + 1:]]
+    results = tournament.run_tournament(pairings, checkpoint=checkpoint, games=games,
+                                        book=book_path if os.path.exists(book_path) else None,
+                                        tablebase=tablebase_path if os.path.exists(tablebase_path) else None)
+    tournament.report(results, players)
 
 
 def main_depth2():
     import time
     L = 7
     res = np.zeros((L, L))
-    board = Board()
+    board = BitBoard()
     board.display()
     bb = board
     color = 'Black'
@@ -552,37 +2188,51 @@ def main_depth2():
         color = another_color(color)
 
 
-def main_evaluation():
-    L = 6
-    res = np.zeros((1, L))
-    for i in range(1, L+1):
-        board = Board()
-        bb = board
-        color = 'Black'
-        n = 0
-        win = -1
-        while n < 200:
-            n += 2
-            # time.sleep(0.5)
-            aa_t, bb_t = alpha_beta_search(bb, color, i, 1)  # Black
-            if aa_t is None:
-                win = 2
-                break
-            else:
-                aa, bb = aa_t, bb_t
-            color = another_color(color)
-            aa_t, bb_t = alpha_beta_search(bb, color, i, 2)  # White
-            if aa_t is None:
-                win = 1
-                break
-            else:
-                aa, bb = aa_t, bb_t
-            color = another_color(color)
-        if win == -1:
-            res[0, i-1] = (len(bb.black_position) - len(bb.white_position))*0.1
-        else:
-            res[0, i-1] = win
-        print(res)
+def main_evaluation(checkpoint='compare_evaluation.jsonl', book_path='opening.ckbk', games='compare_evaluation.ckgr',
+                    tablebase_path='endgame.cktb'):
+    import tournament
+    players = []
+    pairings = []
+    for i in range(1, 7):
+        h1 = tournament.Player('H1 depth %d' % i, i, 1)
+        h2 = tournament.Player('H2 depth %d' % i, i, 2)
+        players += [h1, h2]
+        pairings.append((h1, h2))
+    # games reaching the ply cap go to the side with more pieces
+    results = tournament.run_tournament(pairings, adjudicate=True, checkpoint=checkpoint, games=games,
+                                        book=book_path if os.path.exists(book_path) else None,
+                                        tablebase=tablebase_path if os.path.exists(tablebase_path) else None)
+    tournament.report(results, players)
+
+
+def sample_positions(n=8, plies=40, depth=2):
+    positions = []
+    board = BitBoard()
+    color = 'Black'
+    for ply in range(plies):
+        action, result = alpha_beta_search(board, color, depth, 1)
+        if action is None:
+            break
+        board = result
+        color = another_color(color)
+        if ply % (plies // n) == plies // n - 1:
+            positions.append((board, color))
+    return positions
+
+
+def main_ordering(depth=8):
+    positions = sample_positions()
+    for name, use_tt, use_ordering in [('generation order', False, False),
+                                       ('hash move', True, False),
+                                       ('hash, captures, killers, history', True, True)]:
+        stats = SearchStats()
+        start = time.perf_counter()
+        for board, color in positions:
+            alpha_beta_search(board, color, depth, 1,
+                              tt=TranspositionTable() if use_tt else None,
+                              ordering=MoveOrdering() if use_ordering else None,
+                              stats=stats)
+        print('%-34s %s, time: %.2fs' % (name, stats, time.perf_counter() - start))
 
 
 if __name__ == '__main__':
@@ -602,5 +2252,11 @@ if __name__ == '__main__':
         main_depth()
     elif len(args) > 0 and args[0] == '--compare_evaluation':
         main_evaluation()
+    elif len(args) > 0 and args[0] == '--compare_ordering':
+        main_ordering()
+    elif len(args) > 1 and args[0] == '--movetime':
+        main_user(int(args[1]))
+    elif len(args) > 1 and args[0] == '--stats':
+        main_user(stats_path=args[1])
     else:
         main_user()
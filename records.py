@@ -0,0 +1,202 @@
+# %% import packages
+import json
+import os
+import struct
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from checkers import INDEX_SQUARE, SQUARE_INDEX, Board, BitBoard, SearchStats, TranspositionTable, \
+    alpha_beta_search, another_color, generate_moves, move_notation, search_root
+
+
+# %% Record format
+# A file header, then one record per game, appended as games finish:
+#
+#   u4 length of the rest of the record, u8 seed, u1 winner, u1 draw rule,
+#   u2 plies
+#   game id, black player, white player: u1 length + utf-8 text each
+#   each move: u1 number of squares on its path, then the squares (0-31)
+#
+# A move is identified by its path alone, the captured pieces lie between the
+# landing squares. Games start from the initial position. Version 1 records
+# have no draw rule byte and are still read.
+MAGIC = b'CKGR'
+VERSION = 2
+HEADER = struct.Struct('<4sI')
+GAMES = {1: struct.Struct('<IQBH'), 2: struct.Struct('<IQBBH')}
+WINNERS = [None, 'Black', 'White']
+# The rule that drew the game, as in GameHistory.draw
+DRAWS = [None, 'repetition', 'no progress']
+
+
+def encode_game(record):
+    data = bytearray()
+    for text in (record['game_id'], record['black'], record['white']):
+        text = text.encode()[:255]
+        data.append(len(text))
+        data += text
+    for path in record['moves']:
+        data.append(len(path))
+        data += bytes(SQUARE_INDEX[tuple(pos)] for pos in path)
+    game = GAMES[VERSION]
+    return game.pack(game.size - 4 + len(data), record.get('seed') or 0, WINNERS.index(record['winner']),
+                     DRAWS.index(record.get('draw')), len(record['moves'])) + bytes(data)
+
+
+def decode_game(data, version=VERSION):
+    # data is a whole record, length field included
+    game = GAMES[version]
+    if version == 1:
+        length, seed, winner, plies = game.unpack_from(data)
+        draw = 0
+    else:
+        length, seed, winner, draw, plies = game.unpack_from(data)
+    offset = game.size
+    texts = []
+    for _ in range(3):
+        size = data[offset]
+        texts.append(data[offset + 1:offset + 1 + size].decode())
+        offset += 1 + size
+    moves = []
+    for _ in range(plies):
+        size = data[offset]
+        moves.append([list(INDEX_SQUARE[i]) for i in data[offset + 1:offset + 1 + size]])
+        offset += 1 + size
+    game_id, black, white = texts
+    return {'game_id': game_id, 'black': black, 'white': white, 'seed': seed, 'winner': WINNERS[winner],
+            'plies': plies, 'draw': DRAWS[draw], 'moves': moves}
+
+
+class GameWriter(object):
+    # Appends games to a record file, writing the header if the file is new.
+    # Games are only appended to a file of the current version.
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new:
+            with open(path, 'rb') as f:
+                header = f.read(HEADER.size)
+            if len(header) < HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION):
+                raise ValueError("%s is not a version %d game record file." % (path, VERSION))
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(HEADER.pack(MAGIC, VERSION))
+
+    def write(self, record):
+        self.file.write(encode_game(record))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_games(path, records):
+    with GameWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+
+
+# %% Reading
+def read_games(path):
+    # Yields the games of a record file one at a time, only one game is read
+    # into memory at once
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError("%s is not a game record file." % path)
+        magic, version = HEADER.unpack(header)
+        if magic != MAGIC or version not in GAMES:
+            raise ValueError("%s is not a version %d game record file." % (path, VERSION))
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                return
+            length, = struct.unpack('<I', head)
+            rest = f.read(length)
+            if len(rest) < length:
+                raise ValueError("%s ends inside a game." % path)
+            yield decode_game(head + rest, version)
+
+
+def replay(record, board=None):
+    # Yields (board, color, move) before each move of the game and then plays
+    # the move on the same board, so keep a copy of anything needed later
+    board = Board() if board is None else board
+    color = 'Black'
+    for ply, path in enumerate(record['moves']):
+        path = tuple(tuple(pos) for pos in path)
+        move = None
+        for candidate in generate_moves(board, color):
+            if candidate.path == path:
+                move = candidate
+                break
+        if move is None:
+            raise ValueError("Game %s has an illegal move at ply %d." % (record['game_id'], ply + 1))
+        yield board, color, move
+        board.apply_move(move)
+        color = another_color(color)
+
+
+# %% Analysis
+def analyse_game(record, depth=8, heuristic_type=1):
+    # Searches every position of the game and scores the move played against
+    # the best one, both from the mover's side. delta is how much the played
+    # move gives away.
+    tt = TranspositionTable(16)
+    rows = []
+    for ply, (board, color, move) in enumerate(replay(record, BitBoard())):
+        tt.new_search()
+        stats = SearchStats()
+        best, result = alpha_beta_search(board, color, depth, heuristic_type, tt=tt, stats=stats)
+        score = stats.score
+        if best == list(move.path):
+            played = score
+        else:
+            played = search_root(board, color, [move], maxdepth=depth, heuristic_type=heuristic_type, tt=tt)[1]
+        rows.append({'game_id': record['game_id'], 'ply': ply + 1, 'color': color,
+                     'move': move_notation(move.path), 'best': move_notation(best), 'score': score,
+                     'played': played, 'delta': score - played, 'depth': depth})
+    return rows
+
+
+def analyse(records, depth=8, heuristic_type=1, workers=None, emit=print):
+    # Re-analyses a stream of games on worker processes, emitting one row per
+    # move. At most two games per worker are in flight, so the stream is
+    # never held in memory.
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        limit = 2 * workers
+        pending = set()
+        for record in records:
+            pending.add(pool.submit(analyse_game, record, depth, heuristic_type))
+            if len(pending) >= limit:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for row in future.result():
+                        emit(row)
+        for future in pending:
+            for row in future.result():
+                emit(row)
+
+
+if __name__ == '__main__':
+    # python records.py convert tournament.jsonl games.ckgr
+    # python records.py analyse games.ckgr [depth] [workers] > analysis.jsonl
+    args = sys.argv[1:]
+    if len(args) == 3 and args[0] == 'convert':
+        with open(args[1]) as f:
+            write_games(args[2], (json.loads(line) for line in f if line.strip()))
+    elif len(args) >= 2 and args[0] == 'analyse':
+        def emit(row):
+            print(json.dumps(row))
+            sys.stdout.flush()
+        analyse(read_games(args[1]), int(args[2]) if len(args) > 2 else 8,
+                workers=int(args[3]) if len(args) > 3 else None, emit=emit)
+    else:
+        print('usage: records.py convert <games.jsonl> <games.ckgr> | analyse <games.ckgr> [depth] [workers]')
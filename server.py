@@ -0,0 +1,248 @@
+# %% import packages
+import copy
+import os
+import socketserver
+import sys
+import threading
+
+from checkers import ASPIRATION_WINDOW, HEURISTIC_TYPES, QUIESCENCE_NODES, QUIESCENCE_PLIES, BitBoard, GameHistory, \
+    MoveOrdering, SearchLimits, SearchStats, TranspositionTable, another_color, fen_position, find_move, \
+    generate_moves, is_progress, iterative_deepening, move_notation, position_fen
+
+
+# %% Engine
+# One command per line, answers are lines too:
+#
+#   isready                          -> readyok
+#   newgame                          clears the hash and history tables
+#   setoption <name> <value>         heuristic, hash (MB), quiescence, pvs
+#   position startpos [moves ...]    moves in move_notation, e.g. 9-13 or 18x27
+#   position fen <fen> [moves ...]   fen as written by position_fen
+#   go [movetime ms] [depth d] [nodes n] [infinite]
+#                                    -> info depth d score s nodes n nps n pv ...
+#                                    -> bestmove <move> | bestmove none
+#   ponder                           thinks on the position after the expected reply until stop or position
+#   stop                             ends go (bestmove is still sent) or ponder
+#   d                                -> the position as fen
+#   quit
+class Engine(object):
+    def __init__(self, write, hash_mb=64, book_path='opening.ckbk', tablebase_path='endgame.cktb'):
+        self.write = write
+        self.output = threading.Lock()
+        self.tt = TranspositionTable(hash_mb)
+        self.ordering = MoveOrdering()
+        self.book = None
+        if book_path is not None and os.path.exists(book_path):
+            from book import Book
+            self.book = Book(book_path)
+        self.tablebase = None
+        if tablebase_path is not None and os.path.exists(tablebase_path):
+            from tablebase import Tablebase
+            self.tablebase = Tablebase(tablebase_path)
+        self.heuristic_type = 0
+        self.quiescence = QUIESCENCE_PLIES
+        self.pvs = True
+        self.board, self.color = BitBoard(), 'Black'
+        self.history = GameHistory(self.board, self.color)
+        self.expected = None
+        self.thread = None
+        self.limits = None
+
+    def send(self, line):
+        with self.output:
+            self.write(line)
+
+    def handle(self, line):
+        # Returns False once the engine should exit
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, args = tokens[0], tokens[1:]
+        if command == 'quit':
+            self.stop()
+            return False
+        handler = getattr(self, 'cmd_' + command, None)
+        if handler is None:
+            self.send('error unknown command ' + command)
+        else:
+            try:
+                handler(args)
+            except ValueError as error:
+                self.send('error ' + str(error))
+            except Exception as error:
+                # a bad command must not take the engine down
+                self.send('error %s: %s' % (type(error).__name__, error))
+        return True
+
+    def cmd_isready(self, args):
+        self.send('readyok')
+
+    def cmd_newgame(self, args):
+        self.stop()
+        self.tt.clear()
+        self.ordering.clear()
+        self.board, self.color = BitBoard(), 'Black'
+        self.history = GameHistory(self.board, self.color)
+
+    def cmd_setoption(self, args):
+        if len(args) != 2:
+            raise ValueError("setoption takes a name and a value.")
+        self.stop()
+        name, value = args
+        if name == 'heuristic':
+            if int(value) not in HEURISTIC_TYPES:
+                raise ValueError("heuristic must be one of %s." % ', '.join(map(str, HEURISTIC_TYPES)))
+            self.heuristic_type = int(value)
+        elif name == 'hash':
+            self.tt = TranspositionTable(float(value))
+        elif name == 'quiescence':
+            self.quiescence = int(value)
+        elif name == 'pvs':
+            self.pvs = value.lower() in ('1', 'true', 'on')
+        else:
+            raise ValueError("Unknown option %s." % name)
+
+    def cmd_position(self, args):
+        self.stop()
+        if args[:1] == ['startpos']:
+            board, color = BitBoard(), 'Black'
+            rest = args[1:]
+        elif args[:1] == ['fen'] and len(args) > 1:
+            board, color = fen_position(args[1])
+            rest = args[2:]
+        else:
+            raise ValueError("position needs startpos or fen.")
+        # the moves also give the positions the search treats as repeated
+        history = GameHistory(board, color)
+        if rest[:1] == ['moves']:
+            for text in rest[1:]:
+                move = find_move(board, color, text)
+                if move is None:
+                    raise ValueError("Illegal move %s." % text)
+                progress = is_progress(board, move.path)
+                board.apply_move(move)
+                color = another_color(color)
+                history.push(board, color, progress)
+        self.board, self.color, self.history = board, color, history
+
+    def cmd_d(self, args):
+        self.send(position_fen(self.board, self.color))
+
+    def cmd_go(self, args):
+        self.stop()
+        options = {}
+        for i, token in enumerate(args):
+            if token in ('movetime', 'nodes', 'depth'):
+                if i + 1 >= len(args):
+                    raise ValueError("%s needs a value." % token)
+                options[token] = int(args[i + 1])
+        time_limit_ms = options.get('movetime')
+        node_limit = options.get('nodes')
+        maxdepth = options.get('depth', float('inf'))
+        use_book = 'infinite' not in args
+        self.start(self.board, self.color, SearchLimits(time_limit_ms, node_limit), maxdepth, use_book, True,
+                   self.history.reversible())
+
+    def cmd_ponder(self, args):
+        # Search our reply to the expected move of the opponent, so that the
+        # tables are warm when that move comes
+        self.stop()
+        move = self.expected
+        if move is None or move not in generate_moves(self.board, self.color):
+            return
+        board = copy.copy(self.board)
+        board.apply_move(move)
+        self.start(board, another_color(self.color), SearchLimits(), float('inf'), False, False,
+                   self.history.reversible())
+
+    def cmd_stop(self, args):
+        self.stop()
+
+    def stop(self):
+        if self.thread is not None:
+            self.limits.stop()
+            self.thread.join()
+            self.thread = None
+
+    def start(self, board, color, limits, maxdepth, use_book, answer, history):
+        self.limits = limits
+        self.thread = threading.Thread(target=self.search,
+                                       args=(board, color, limits, maxdepth, use_book, answer, history))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def search(self, board, color, limits, maxdepth, use_book, answer, history):
+        # A failed search still answers, so a client waiting on bestmove
+        # does not hang
+        try:
+            self.think(board, color, limits, maxdepth, use_book, answer, history)
+        except Exception as error:
+            self.send('error %s: %s' % (type(error).__name__, error))
+            if answer:
+                self.expected = None
+                self.send('bestmove none')
+
+    def think(self, board, color, limits, maxdepth, use_book, answer, history):
+        if use_book and self.book is not None:
+            move = self.book.choose(board, color)
+            if move is not None:
+                self.expected = None
+                self.send('bestmove ' + move_notation(move.path))
+                return
+        stats = SearchStats()
+
+        def report(depth, action):
+            if answer:
+                self.send('info depth %d score %.4f nodes %d nps %d pv %s'
+                          % (depth, stats.score, stats.nodes, stats.nps(),
+                             ' '.join(move_notation(move.path) for move in stats.pv)))
+        action, result = iterative_deepening(board, color, maxdepth=maxdepth, heuristic_type=self.heuristic_type,
+                                             tt=self.tt, ordering=self.ordering, stats=stats,
+                                             tablebase=self.tablebase, quiescence=self.quiescence,
+                                             quiescence_nodes=QUIESCENCE_NODES, pvs=self.pvs,
+                                             aspiration=ASPIRATION_WINDOW.get(self.heuristic_type), limits=limits,
+                                             report=report, history=history)
+        if answer:
+            self.expected = stats.pv[1] if len(stats.pv) > 1 else None
+            self.send('bestmove ' + (move_notation(action) if action is not None else 'none'))
+
+
+def serve(lines, write, **options):
+    engine = Engine(write, **options)
+    for line in lines:
+        if not engine.handle(line):
+            break
+    engine.stop()
+
+
+# %% Transports
+def main_stdio():
+    def write(line):
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+    serve(sys.stdin, write)
+
+
+class EngineHandler(socketserver.StreamRequestHandler):
+    # One engine, with its own tables, per connection
+    def handle(self):
+        def write(line):
+            self.wfile.write((line + '\n').encode())
+            self.wfile.flush()
+        serve((line.decode() for line in self.rfile), write)
+
+
+def main_socket(port, host='127.0.0.1'):
+    with socketserver.ThreadingTCPServer((host, port), EngineHandler) as server:
+        server.daemon_threads = True
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    # python server.py              speaks the protocol on stdin/stdout
+    # python server.py --port 7000  accepts connections on a local socket
+    args = sys.argv[1:]
+    if len(args) > 1 and args[0] == '--port':
+        main_socket(int(args[1]))
+    else:
+        main_stdio()
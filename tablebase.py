@@ -0,0 +1,270 @@
+# %% import packages
+import mmap
+import struct
+import sys
+import time
+from array import array
+from math import comb
+
+import numpy as np
+
+from checkers import BitBoard, BIT_FULL, Position, bit_count, bit_indices, bitboard_generate, position_masks
+
+
+# %% Position indexing
+# A table holds every placement of one material signature (black men, black
+# kings, white men, white kings) for both sides to move. The four piece sets
+# are ranked one after the other with the combinatorial number system, each
+# over the squares the previous sets left free.
+MAGIC = b'CKTB'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+ENTRY = struct.Struct('<4BQQ')
+
+# One byte per position: 0 draw, 255 not a legal placement, odd codes a loss
+# in (code - 1) / 2 plies and even codes a win in (code - 2) / 2 plies for the
+# side to move.
+DRAW, INVALID = 0, 255
+MAX_DISTANCE = 126
+# Black men never stand on the last row, white men never on the first
+BLACK_MEN_SQUARES = BIT_FULL & ~(0xF << 28)
+WHITE_MEN_SQUARES = BIT_FULL & ~0xF
+
+
+def loss_code(distance):
+    return 1 + 2 * distance
+
+
+def win_code(distance):
+    return 2 + 2 * distance
+
+
+def decode(code):
+    if code == DRAW:
+        return 'draw', 0
+    if code == INVALID:
+        return None
+    if code & 1:
+        return 'loss', (code - 1) // 2
+    return 'win', (code - 2) // 2
+
+
+def signatures(max_pieces):
+    # Sorted so that every move leads to a table that is already solved:
+    # captures lower the piece count and promotions the number of men.
+    result = []
+    for total in range(2, max_pieces + 1):
+        for bm in range(total + 1):
+            for bk in range(total + 1 - bm):
+                for wm in range(total + 1 - bm - bk):
+                    wk = total - bm - bk - wm
+                    if bm + bk > 0 and wm + wk > 0:
+                        result.append((bm, bk, wm, wk))
+    return sorted(result, key=lambda s: (sum(s), s[0] + s[2], s))
+
+
+def table_size(signature):
+    size = 2
+    free = 32
+    for count in signature:
+        size *= comb(free, count)
+        free -= count
+    return size
+
+
+def rank_subset(mask, used):
+    rank = 0
+    for k, i in enumerate(bit_indices(mask)):
+        rank += comb(i - bit_count(used & ((1 << i) - 1)), k + 1)
+    return rank
+
+
+def unrank_subset(rank, count, used):
+    free = [i for i in range(32) if not (used >> i) & 1]
+    mask = 0
+    for k in range(count, 0, -1):
+        p = k - 1
+        while comb(p + 1, k) <= rank:
+            p += 1
+        rank -= comb(p, k)
+        mask |= 1 << free[p]
+    return mask
+
+
+def position_index(black, white, kings, color):
+    sets = (black & ~kings, black & kings, white & ~kings, white & kings)
+    signature = tuple(bit_count(s) for s in sets)
+    index = 0
+    used = 0
+    free = 32
+    for s, count in zip(sets, signature):
+        index = index * comb(free, count) + rank_subset(s, used)
+        used |= s
+        free -= count
+    return signature, index * 2 + (1 if color == 'White' else 0)
+
+
+def position_at(signature, index):
+    color = 'White' if index & 1 else 'Black'
+    index //= 2
+    radices = []
+    free = 32
+    for count in signature:
+        radices.append(comb(free, count))
+        free -= count
+    ranks = []
+    for radix in reversed(radices):
+        ranks.append(index % radix)
+        index //= radix
+    ranks.reverse()
+    sets = []
+    used = 0
+    for rank, count in zip(ranks, signature):
+        s = unrank_subset(rank, count, used)
+        sets.append(s)
+        used |= s
+    black_men, black_kings, white_men, white_kings = sets
+    return Position(black_men | black_kings, white_men | white_kings, black_kings | white_kings, color)
+
+
+# %% Retrograde generation
+def child_links(signature, ids):
+    # For every position of the table, the (table, index) of each child.
+    # Children whose side to move has no piece left are linked to table -1.
+    # The links are collected in typed arrays, 12 bytes each, as a table
+    # has several times more links than positions.
+    size = table_size(signature)
+    codes = np.zeros(size, dtype=np.uint8)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    tables, indexes = array('i'), array('q')
+    for index in range(size):
+        black, white, kings, color = position_at(signature, index)
+        if (black & ~kings & ~BLACK_MEN_SQUARES) or (white & ~kings & ~WHITE_MEN_SQUARES):
+            codes[index] = INVALID
+        else:
+            board = BitBoard(black, white, kings, 0)
+            moves = bitboard_generate(board, color)
+            if not moves:
+                codes[index] = loss_code(0)
+            for move in moves:
+                undo = board.apply_move(move)
+                if not (board.white if color == 'Black' else board.black):
+                    tables.append(-1)
+                    indexes.append(0)
+                else:
+                    child, child_index = position_index(board.black, board.white, board.kings,
+                                                        'White' if color == 'Black' else 'Black')
+                    tables.append(ids[child])
+                    indexes.append(child_index)
+                board.undo_move(move, undo)
+        offsets[index + 1] = len(tables)
+    return codes, offsets, np.frombuffer(tables, dtype=np.int32), np.frombuffer(indexes, dtype=np.int64)
+
+
+def solve_table(table_id, codes, offsets, tables, indexes, solved):
+    # Children in other tables are final. Round d resolves the wins in d plies
+    # (a child lost in d - 1) and the losses in d plies (every child won, the
+    # longest in d - 1); whatever is left at the fixpoint is a draw.
+    own = tables == table_id
+    static = np.full(len(tables), loss_code(0), dtype=np.uint8)
+    for other in np.unique(tables[(tables >= 0) & ~own]):
+        selected = tables == other
+        static[selected] = solved[other][indexes[selected]]
+    # a trailing dummy child keeps reduceat in range for childless positions
+    own = np.append(own, False)
+    static = np.append(static, INVALID)
+    indexes = np.append(indexes, 0)
+    starts = np.minimum(offsets[:-1], len(static) - 1)
+    children = offsets[1:] - offsets[:-1]
+    known = static[static != INVALID]
+    longest = int(known.max()) // 2 if known.size else 0
+    distance = 1
+    while True:
+        child = static.copy()
+        child[own] = codes[indexes[own]]
+        lost = (child & 1).astype(bool) & (child != INVALID)
+        won = ~lost & (child != DRAW) & (child != INVALID)
+        loss_distance = np.where(lost, (child.astype(np.int32) - 1) // 2, 1 << 20)
+        win_distance = np.where(won, (child.astype(np.int32) - 2) // 2, -1)
+        open_ = (codes == DRAW) & (children > 0)
+        new_wins = open_ & (np.minimum.reduceat(loss_distance, starts) <= distance - 1)
+        new_losses = open_ & ~new_wins & (np.add.reduceat(won.astype(np.int32), starts) == children) \
+            & (np.maximum.reduceat(win_distance, starts) <= distance - 1)
+        if new_wins.any() or new_losses.any():
+            if distance > MAX_DISTANCE:
+                raise ValueError("Distance to win does not fit in one byte.")
+            codes[new_wins] = win_code(distance)
+            codes[new_losses] = loss_code(distance)
+        elif distance > longest + 1:
+            return codes
+        distance += 1
+
+
+def generate(path, max_pieces=4, verbose=True):
+    ids = {}
+    solved = []
+    for signature in signatures(max_pieces):
+        start = time.perf_counter()
+        ids[signature] = len(solved)
+        codes, offsets, tables, indexes = child_links(signature, ids)
+        solved.append(solve_table(ids[signature], codes, offsets, tables, indexes, solved))
+        if verbose:
+            print('%s: %d positions, %d wins, %d losses, %.1fs'
+                  % (signature, len(codes), np.count_nonzero((codes & 1 == 0) & (codes != DRAW)),
+                     np.count_nonzero((codes & 1 == 1) & (codes != INVALID)), time.perf_counter() - start))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, max_pieces, len(solved)))
+        offset = HEADER.size + ENTRY.size * len(solved)
+        for signature, codes in zip(ids, solved):
+            f.write(ENTRY.pack(*signature, offset, len(codes)))
+            offset += len(codes)
+        for codes in solved:
+            f.write(codes.tobytes())
+
+
+# %% Probing
+class Tablebase(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        # Read-only shared mapping: every process probing the same file shares
+        # one copy in the page cache and lookups never copy the tables.
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.max_pieces, count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d tablebase." % (path, VERSION))
+        self.tables = {}
+        for k in range(count):
+            bm, bk, wm, wk, offset, size = ENTRY.unpack_from(self.data, HEADER.size + ENTRY.size * k)
+            self.tables[(bm, bk, wm, wk)] = offset
+        self.hits = 0
+
+    def __getstate__(self):
+        # Worker processes map the file themselves
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def probe(self, board, color):
+        # ('win' | 'loss' | 'draw', plies) for the side to move, or None
+        if sum(board.piece_counts()) > self.max_pieces:
+            return None
+        black, white, kings = position_masks(board)
+        if not black or not white:
+            return None
+        signature, index = position_index(black, white, kings, color)
+        offset = self.tables.get(signature)
+        if offset is None:
+            return None
+        self.hits += 1
+        return decode(self.data[offset + index])
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    generate(args[1] if len(args) > 1 else 'endgame.cktb', int(args[0]) if args else 4)
@@ -0,0 +1,101 @@
+# %% import packages
+import random
+
+import pytest
+
+from checkers import WIN_SCORE, Board, BitBoard, all_moves, another_color, fen_position, generate_moves, is_over, \
+    move_notation, score_from_tt, score_to_tt
+
+
+def boards(fen):
+    # The position as a BitBoard and as a Board, with the side to move
+    board, color = fen_position(fen)
+    return [board, board.to_board()], color
+
+
+# %% Game over
+@pytest.mark.parametrize('kind', [0, 1])
+def test_no_pieces_is_over(kind):
+    positions, color = boards('B:W21:B')
+    board = positions[kind]
+    assert is_over(board, color)
+    assert not board.has_moves(color)
+    assert not is_over(board, another_color(color))
+
+
+@pytest.mark.parametrize('kind', [0, 1])
+def test_blocked_pieces_are_over(kind):
+    # The black man on 1 cannot step to 5 or 6, and cannot jump 6 as 10 is taken
+    positions, color = boards('B:W5,6,10:B1')
+    board = positions[kind]
+    assert is_over(board, color)
+    assert not board.has_moves(color)
+    assert not board.has_jumps(color)
+    assert generate_moves(board, color) == []
+
+
+@pytest.mark.parametrize('kind', [0, 1])
+def test_jump_only_position(kind):
+    # 5 blocks the only step, so capturing 6 is the one move
+    positions, color = boards('B:W5,6:B1')
+    board = positions[kind]
+    assert not is_over(board, color)
+    assert board.has_moves(color)
+    assert board.has_jumps(color)
+    assert [move_notation(move.path) for move in generate_moves(board, color)] == ['1x10']
+
+
+def test_blocked_piece_regression():
+    # is_over used to test the (moves, results) tuple of all_moves, which is
+    # truthy even when both lists are empty, so blocked pieces never ended the game
+    board, color = fen_position('B:W5,6,10:B1')
+    board = board.to_board()
+    assert all_moves(board, 0, 1) == ([], [])
+    assert is_over(board, color)
+
+
+def test_board_and_bitboard_agree():
+    rng = random.Random(7)
+    checked = 0
+    for game in range(40):
+        board, color = BitBoard(), 'Black'
+        for ply in range(120):
+            legacy = board.to_board()
+            assert isinstance(legacy, Board)
+            for side in ('Black', 'White'):
+                assert is_over(board, side) == is_over(legacy, side)
+                assert board.has_moves(side) == legacy.has_moves(side)
+                assert board.has_jumps(side) == legacy.has_jumps(side)
+                assert sorted(generate_moves(board, side)) == sorted(generate_moves(legacy, side))
+            checked += 1
+            moves = generate_moves(board, color)
+            if not moves:
+                break
+            board.apply_move(rng.choice(moves))
+            color = another_color(color)
+    assert checked > 1000
+
+
+# %% Transposition table
+def test_win_scores_count_from_the_stored_node():
+    # A win 7 plies from the root found at ply 3 is 4 plies from that node,
+    # and 6 plies from the root when the node comes up again at ply 2
+    stored = score_to_tt(WIN_SCORE - 7, 3)
+    assert stored == WIN_SCORE - 4
+    assert score_from_tt(stored, 2) == WIN_SCORE - 6
+    assert score_from_tt(score_to_tt(-(WIN_SCORE - 7), 3), 2) == -(WIN_SCORE - 6)
+    assert score_to_tt(1.5, 3) == score_from_tt(1.5, 3) == 1.5
+
+
+# %% Tournament
+def test_tournament_games_use_book(tmp_path):
+    # The book covers the first two plies, which fall inside the opening plies
+    from book import build_from_search, write_book
+    from tournament import GameSpec, Player, play_game
+    path = str(tmp_path / 'opening.ckbk')
+    write_book(path, build_from_search(plies=2, depth=1, verbose=False))
+    player = tuple(Player('depth 1', 1, 1))
+    record = play_game(GameSpec('book', player, player, 0, 4, 8, False, path, None))
+    assert record['book_plies'] == 2
+    record = play_game(GameSpec('no book', player, player, 0, 4, 8, False, None, None))
+    assert record['book_plies'] == 0
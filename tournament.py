@@ -0,0 +1,218 @@
+# %% import packages
+import hashlib
+import json
+import math
+import os
+import random
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from checkers import DRAW_RULES, QUIESCENCE_NODES, BitBoard, GameHistory, MoveOrdering, TranspositionTable, \
+    alpha_beta_search, another_color, generate_moves, is_progress, move_result
+from records import GameWriter
+
+
+# %% Players and games
+# quiescence: plies searched past depth while a capture is pending
+Player = namedtuple('Player', ['name', 'depth', 'heuristic_type', 'quiescence'], defaults=(0,))
+# book and tablebase are file paths, each process opens the files itself
+GameSpec = namedtuple('GameSpec', ['game_id', 'black', 'white', 'seed', 'opening_plies', 'max_plies', 'adjudicate',
+                                   'book', 'draw_rules', 'tablebase'], defaults=(None,))
+
+
+def spec_key(spec):
+    # Covers everything that decides a game (players, seed, opening, ply cap,
+    # book, draw rules, tablebase), so a checkpoint only resumes games with
+    # the same spec
+    return hashlib.sha1(json.dumps(list(spec)).encode()).hexdigest()[:16]
+
+
+def play_game(spec):
+    # Plays one game and returns a json-friendly record. The first
+    # opening_plies moves come from the opening book, or are random (seeded)
+    # once the book has no move, so games are not identical replays. After
+    # them, both players still take book moves while the book has any.
+    # With draw_rules, the game ends as soon as one of them draws it and the
+    # searches score repeated positions as draws.
+    rng = random.Random(spec.seed)
+    book = None
+    if spec.book is not None:
+        from book import Book
+        book = Book(spec.book)
+    tablebase = None
+    if spec.tablebase is not None:
+        from tablebase import Tablebase
+        tablebase = Tablebase(spec.tablebase)
+    board = BitBoard()
+    color = 'Black'
+    players = {'Black': Player(*spec.black), 'White': Player(*spec.white)}
+    tables = {'Black': TranspositionTable(16), 'White': TranspositionTable(16)}
+    orderings = {'Black': MoveOrdering(), 'White': MoveOrdering()}
+    game = GameHistory(board, color, spec.draw_rules) if spec.draw_rules is not None else None
+    moves = []
+    book_plies = 0
+    winner = None
+    draw = None
+    while len(moves) < spec.max_plies:
+        previous = board
+        move = book.choose(board, color, rng) if book is not None else None
+        if move is not None:
+            book_plies += 1
+            action, board = list(move.path), move_result(board, move)
+        elif len(moves) < spec.opening_plies:
+            options = generate_moves(board, color)
+            action = None
+            if options:
+                move = rng.choice(options)
+                action, board = list(move.path), move_result(board, move)
+        else:
+            player = players[color]
+            action, result = alpha_beta_search(board, color, player.depth, player.heuristic_type,
+                                               tt=tables[color], ordering=orderings[color], tablebase=tablebase,
+                                               quiescence=player.quiescence, quiescence_nodes=QUIESCENCE_NODES,
+                                               history=game.reversible() if game is not None else None)
+            if action is not None:
+                board = result
+        if action is None:
+            winner = another_color(color)
+            break
+        moves.append(action)
+        color = another_color(color)
+        if game is not None:
+            game.push(board, color, is_progress(previous, action))
+            draw = game.draw()
+            if draw is not None:
+                break
+    if tablebase is not None:
+        tablebase.close()
+    if winner is None and draw is None and spec.adjudicate:
+        black, white = len(board.black_position), len(board.white_position)
+        if black != white:
+            winner = 'Black' if black > white else 'White'
+    return {'game_id': spec.game_id, 'black': players['Black'].name, 'white': players['White'].name,
+            'seed': spec.seed, 'spec': spec_key(spec), 'winner': winner, 'plies': len(moves), 'draw': draw,
+            'book_plies': book_plies, 'moves': [[list(pos) for pos in move] for move in moves]}
+
+
+# %% Scheduling
+def schedule(pairings, games_per_pair=8, opening_plies=4, max_plies=200, seed=0, adjudicate=False, book=None,
+             draw_rules=DRAW_RULES, tablebase=None):
+    # Each pairing plays games_per_pair games; every two consecutive games
+    # share an opening and swap colours.
+    specs = []
+    for i, (a, b) in enumerate(pairings):
+        for k in range(games_per_pair):
+            game_seed = (seed * 1000003 + i) * 1009 + k // 2
+            black, white = (a, b) if k % 2 == 0 else (b, a)
+            game_id = '%s vs %s #%d' % (a.name, b.name, k)
+            specs.append(GameSpec(game_id, tuple(black), tuple(white), game_seed, opening_plies, max_plies,
+                                  adjudicate, book, draw_rules, tablebase))
+    return specs
+
+
+def load_checkpoint(path):
+    # Records by spec_key; records written without one are never reused
+    results = {}
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    if 'spec' in record:
+                        results[record['spec']] = record
+    return results
+
+
+def run_tournament(pairings, games_per_pair=8, opening_plies=4, max_plies=200, seed=0, adjudicate=False,
+                   book=None, workers=None, checkpoint=None, games=None, draw_rules=DRAW_RULES, tablebase=None,
+                   verbose=True):
+    # Finished games go to the checkpoint as json lines and, if games is set,
+    # to that game record file
+    specs = schedule(pairings, games_per_pair, opening_plies, max_plies, seed, adjudicate, book, draw_rules,
+                     tablebase)
+    done = load_checkpoint(checkpoint)
+    todo = [spec for spec in specs if spec_key(spec) not in done]
+    if verbose and done:
+        print('%d games loaded from %s' % (len(specs) - len(todo), checkpoint))
+    out = open(checkpoint, 'a') if checkpoint is not None else None
+    writer = GameWriter(games) if games is not None else None
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(play_game, spec) for spec in todo]
+            for future in as_completed(futures):
+                record = future.result()
+                done[record['spec']] = record
+                if out is not None:
+                    out.write(json.dumps(record) + '\n')
+                    out.flush()
+                if writer is not None:
+                    writer.write(record)
+                if verbose:
+                    print('%-40s winner: %-5s plies: %d book: %d' % (record['game_id'], record['winner'],
+                                                                    record['plies'], record['book_plies']))
+    finally:
+        if out is not None:
+            out.close()
+        if writer is not None:
+            writer.close()
+    return [done[spec_key(spec)] for spec in specs if spec_key(spec) in done]
+
+
+# %% Reporting
+def score(results, name, opponent):
+    win, draw, loss = 0, 0, 0
+    for record in results:
+        if {record['black'], record['white']} != {name, opponent}:
+            continue
+        if record['winner'] is None:
+            draw += 1
+        elif record[record['winner'].lower()] == name:
+            win += 1
+        else:
+            loss += 1
+    return win, draw, loss
+
+
+def elo(win, draw, loss, z=1.96, prior=1):
+    # Elo difference and the Wilson score interval around it. prior draws are
+    # added to the games, so a short unanimous match still gives a finite
+    # estimate and an interval of some width.
+    n = win + draw + loss
+    if n == 0:
+        return 0.0, -float('inf'), float('inf')
+    draw += prior
+    n += prior
+    p = (win + 0.5 * draw) / n
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    margin = z / (1 + z * z / n) * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+
+    def to_elo(q):
+        if q <= 0:
+            return -float('inf')
+        if q >= 1:
+            return float('inf')
+        return 400 * math.log10(q / (1 - q))
+    return to_elo(p), to_elo(centre - margin), to_elo(centre + margin)
+
+
+def report(results, players):
+    names = [player.name for player in players]
+    width = max(len(name) for name in names) + 2
+    print(' ' * width + ''.join('%*s' % (width, name) for name in names))
+    for name in names:
+        row = ''
+        for opponent in names:
+            win, draw, loss = score(results, name, opponent)
+            row += '%*s' % (width, '-' if name == opponent or win + draw + loss == 0
+                            else '%g/%d' % (win + 0.5 * draw, win + draw + loss))
+        print('%-*s' % (width, name) + row)
+    print()
+    for i, name in enumerate(names):
+        for opponent in names[i + 1:]:
+            win, draw, loss = score(results, name, opponent)
+            if win + draw + loss == 0:
+                continue
+            diff, low, high = elo(win, draw, loss)
+            print('%s vs %s: +%d =%d -%d, Elo %+.0f [%+.0f, %+.0f]' % (name, opponent, win, draw, loss,
+                                                                     diff, low, high))
@@ -0,0 +1,99 @@
+# %% import packages
+import json
+import sys
+import time
+from array import array
+
+import numpy as np
+
+from checkers import DEFAULT_WEIGHTS, TUNED_FEATURES, WEIGHTS_PATH, BitBoard, batch_features, encode_masks
+from records import read_games, replay
+from tournament import Player, run_tournament
+
+
+# %% Self-play
+def play(games, path, depth=4, opening_plies=8, max_plies=200, seed=0, workers=None):
+    # Depth-limited H1 against H2 games, appended to the game record file at
+    # path. Long random openings keep the positions varied.
+    pairings = [(Player('H1 depth %d' % depth, depth, 1), Player('H2 depth %d' % depth, depth, 2))]
+    return run_tournament(pairings, games_per_pair=games, opening_plies=opening_plies, max_plies=max_plies,
+                          seed=seed, workers=workers, games=path, verbose=False)
+
+
+# %% Dataset
+# Positions are turned into features in chunks, so the N x 3 x 32 bit arrays
+# of encode_masks stay small
+CHUNK = 100000
+
+
+def extract(paths, skip_plies=8):
+    # Features of the quiet positions (no capture pending) of the stored
+    # games, with the result of each game for Black: 1 won, 0.5 drawn, 0 lost.
+    # The first skip_plies positions of a game are left out.
+    black, white, kings, results = array('I'), array('I'), array('I'), array('f')
+    for path in paths:
+        for record in read_games(path):
+            result = {'Black': 1.0, 'White': 0.0, None: 0.5}[record['winner']]
+            for ply, (board, color, move) in enumerate(replay(record, BitBoard())):
+                if ply < skip_plies or board.has_jumps(color):
+                    continue
+                black.append(board.black)
+                white.append(board.white)
+                kings.append(board.kings)
+                results.append(result)
+    masks = np.stack([np.frombuffer(black, dtype=np.uint32), np.frombuffer(white, dtype=np.uint32),
+                      np.frombuffer(kings, dtype=np.uint32)], 1)
+    features = np.zeros((len(masks), len(TUNED_FEATURES)))
+    for start in range(0, len(masks), CHUNK):
+        features[start:start + CHUNK] = batch_features(encode_masks(masks[start:start + CHUNK]))
+    return features, np.frombuffer(results, dtype=np.float32).astype(float)
+
+
+# %% Fitting
+def loss(features, results, weights):
+    # Mean cross entropy of the predicted results 1 / (1 + exp(-score))
+    scores = features @ weights
+    return float(np.mean(np.logaddexp(0, scores) - results * scores))
+
+
+def fit(features, results, weights=None, iterations=20, l2=1e-4, tolerance=1e-9):
+    # Newton steps on the regularised logistic loss, over the whole dataset
+    n, k = features.shape
+    weights = np.zeros(k) if weights is None else np.array(weights, dtype=float)
+    for _ in range(iterations):
+        p = 1.0 / (1.0 + np.exp(-(features @ weights)))
+        gradient = features.T @ (p - results) / n + l2 * weights
+        hessian = (features * (p * (1 - p))[:, None]).T @ features / n + l2 * np.eye(k)
+        step = np.linalg.solve(hessian, gradient)
+        weights = weights - step
+        if np.abs(step).max() < tolerance:
+            break
+    return weights
+
+
+def write_weights(weights, path=WEIGHTS_PATH, **info):
+    data = {'features': TUNED_FEATURES, 'weights': [float(w) for w in weights]}
+    data.update(info)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1)
+
+
+if __name__ == '__main__':
+    # python tuning.py play <games> <games.ckgr> [depth]
+    # python tuning.py fit <games.ckgr> [more.ckgr ...]   writes weights.json
+    args = sys.argv[1:]
+    if len(args) >= 3 and args[0] == 'play':
+        play(int(args[1]), args[2], int(args[3]) if len(args) > 3 else 4)
+    elif len(args) >= 2 and args[0] == 'fit':
+        start = time.perf_counter()
+        features, results = extract(args[1:])
+        print('%d positions, %.1fs' % (len(results), time.perf_counter() - start))
+        weights = fit(features, results)
+        print('loss %.5f with the default weights, %.5f tuned'
+              % (loss(features, results, np.array(DEFAULT_WEIGHTS)), loss(features, results, weights)))
+        for name, weight in zip(TUNED_FEATURES, weights):
+            print('%-14s %8.4f' % (name, weight))
+        write_weights(weights, positions=len(results), games=args[1:])
+        print('weights written to %s, %.1fs' % (WEIGHTS_PATH, time.perf_counter() - start))
+    else:
+        print('usage: tuning.py play <games> <games.ckgr> [depth] | fit <games.ckgr> ...')